@@ -0,0 +1,142 @@
+import asyncio
+import os
+import logging
+from typing import List, Dict, Any, Optional
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
+
+logger = logging.getLogger(__name__)
+
+# Used when the rate limits can't be read from the API response headers
+DEFAULT_MAX_REQUESTS_PER_MINUTE = 3500
+DEFAULT_MAX_TOKENS_PER_MINUTE = 90000
+
+# Failures worth retrying; anything else (bad request, auth, ...) would fail the same way again
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)  # APITimeoutError is an APIConnectionError
+MAX_RETRY_DELAY = 60
+
+class _Capacity:
+    """Token buckets for requests and tokens, refilled once per second"""
+    
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.condition = asyncio.Condition()
+    
+    async def refill(self) -> None:
+        """Top both buckets up every second, never exceeding one minute of budget"""
+        while True:
+            await asyncio.sleep(1)
+            async with self.condition:
+                self.requests = min(self.rpm, self.requests + self.rpm / 60)
+                self.tokens = min(self.tpm, self.tokens + self.tpm / 60)
+                self.condition.notify_all()
+    
+    async def acquire(self, tokens: int) -> None:
+        """Wait until one request and the estimated tokens are available, then consume them"""
+        # A single request larger than the whole per-minute budget could never run
+        tokens = min(tokens, self.tpm)
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.requests >= 1 and self.tokens >= tokens)
+            self.requests -= 1
+            self.tokens -= tokens
+
+def _estimate_tokens(messages: List[Dict[str, Any]], max_tokens: int) -> int:
+    """Rough token cost of a request: ~4 characters per prompt token plus the completion budget"""
+    prompt_chars = sum(len(str(message.get("content", ""))) for message in messages)
+    return prompt_chars // 4 + max_tokens
+
+async def _read_rate_limits(client: AsyncOpenAI, model: str) -> tuple:
+    """Read the account's request and token limits from a 1-token preflight request"""
+    try:
+        raw = await client.chat.completions.with_raw_response.create(
+            model=model,
+            messages=[{"role": "user", "content": "hi"}],
+            max_tokens=1
+        )
+        rpm = int(raw.headers.get("x-ratelimit-limit-requests", DEFAULT_MAX_REQUESTS_PER_MINUTE))
+        tpm = int(raw.headers.get("x-ratelimit-limit-tokens", DEFAULT_MAX_TOKENS_PER_MINUTE))
+        return rpm, tpm
+    except Exception as e:
+        logger.warning(f"Could not read rate limits, using defaults: {e}")
+        return DEFAULT_MAX_REQUESTS_PER_MINUTE, DEFAULT_MAX_TOKENS_PER_MINUTE
+
+async def run_batch(
+    prompts: List[List[Dict[str, Any]]],
+    model: str = "gpt-3.5-turbo",
+    rpm: Optional[int] = None,
+    tpm: Optional[int] = None,
+    max_attempts: int = 5,
+    temperature: float = 0.7,
+    max_tokens: int = 800,
+    client: Optional[AsyncOpenAI] = None
+) -> List[Optional[str]]:
+    """
+    Run many chat completions concurrently within the RPM/TPM limits
+    
+    Args:
+        prompts: One list of chat messages per request
+        model: Chat model to use
+        rpm: Max requests per minute (read from the API when omitted)
+        tpm: Max tokens per minute (read from the API when omitted)
+        max_attempts: Attempts per request before giving up
+    
+    Returns:
+        Answer text per prompt, in the original order (None for requests that failed)
+    """
+    if not prompts:
+        return []
+    
+    client = client or AsyncOpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+    if rpm is None or tpm is None:
+        limits = await _read_rate_limits(client, model)
+        rpm = rpm or limits[0]
+        tpm = tpm or limits[1]
+    
+    capacity = _Capacity(rpm, tpm)
+    pending: asyncio.Queue = asyncio.Queue()
+    finished: asyncio.Queue = asyncio.Queue()
+    for index, messages in enumerate(prompts):
+        pending.put_nowait((index, messages, 1))
+    
+    async def worker() -> None:
+        while True:
+            index, messages, attempt = await pending.get()
+            await capacity.acquire(_estimate_tokens(messages, max_tokens))
+            try:
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens
+                )
+                await finished.put((index, response.choices[0].message.content.strip()))
+            except RETRYABLE_ERRORS as e:
+                if attempt >= max_attempts:
+                    logger.error(f"Request {index} failed after {attempt} attempts: {e}")
+                    await finished.put((index, None))
+                    continue
+                
+                # Exponential backoff before requeueing, without holding up the other workers
+                logger.warning(f"Request {index} failed (attempt {attempt}), retrying: {e}")
+                await asyncio.sleep(min(2 ** attempt, MAX_RETRY_DELAY))
+                pending.put_nowait((index, messages, attempt + 1))
+            except Exception as e:
+                logger.error(f"Request {index} failed: {e}")
+                await finished.put((index, None))
+    
+    refill_task = asyncio.create_task(capacity.refill())
+    workers = [asyncio.create_task(worker()) for _ in range(min(len(prompts), rpm, 50))]
+    
+    results: List[Optional[str]] = [None] * len(prompts)
+    try:
+        for _ in range(len(prompts)):
+            index, answer = await finished.get()
+            results[index] = answer
+    finally:
+        for task in workers + [refill_task]:
+            task.cancel()
+    
+    logger.info(f"Completed batch of {len(prompts)} requests")
+    return results
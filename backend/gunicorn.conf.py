@@ -0,0 +1,10 @@
+# Picked up automatically by gunicorn when started from backend/
+import os
+
+worker_class = 'uvicorn.workers.UvicornWorker'
+bind = os.environ.get('BIND', '0.0.0.0:8001')
+preload_app = True
+
+def post_fork(server, worker):
+    """Tell the worker how many siblings share the CPU, however -w was given"""
+    os.environ['WEB_CONCURRENCY'] = str(server.cfg.workers)
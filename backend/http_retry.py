@@ -0,0 +1,21 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# Responses worth retrying, and the longest we'll wait between attempts
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+MAX_RETRY_DELAY = 60.0
+
+def retry_delay(retry_after: Optional[str], attempt: int) -> float:
+    """Seconds to wait before the next attempt: the server's Retry-After when given, else exponential backoff"""
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), MAX_RETRY_DELAY)
+        except ValueError:
+            pass
+        try:
+            wait = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            return min(max(wait, 0.0), MAX_RETRY_DELAY)
+        except (TypeError, ValueError):
+            pass
+    return min(0.5 * 2 ** (attempt - 1), MAX_RETRY_DELAY)
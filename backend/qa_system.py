@@ -1,66 +1,171 @@
-from openai import OpenAI
+from openai import AsyncOpenAI
 import os
-from typing import List, Dict, Any, Optional
+import asyncio
+from typing import List, Dict, Any, Optional, ClassVar, AsyncIterator, Tuple
 import logging
-from .vector_store import vector_store
 import json
+import orjson
 import re
+import hashlib
+import base64
+import binascii
+import threading
+from itertools import islice
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+import numpy as np
+
+# server.py runs from backend/ and imports its modules top-level
+try:
+    from .vector_store import VectorStore, RetrievedDoc
+except ImportError:
+    from vector_store import VectorStore, RetrievedDoc
 
 logger = logging.getLogger(__name__)
 
+_SEP = "-" * 50
+
+# Leading bytes of the image formats the vision API accepts
+_IMAGE_SIGNATURES = (
+    (b"\x89PNG", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+    (b"RIFF", "image/webp"),
+)
+
+def image_data_url(image_base64: str) -> str:
+    """
+    Wrap a base64 image in a data URL, sniffing its type from the first decoded bytes only
+    
+    Whitespace and URL-safe characters are normalized to the standard, padded alphabet the API
+    expects; an image whose leading bytes don't decode or match a known format is sent as image/png.
+    """
+    if image_base64.startswith("data:"):
+        return image_base64
+    image_base64 = "".join(image_base64.split()).replace("-", "+").replace("_", "/")
+    # URL-safe base64 usually drops its padding
+    image_base64 += "=" * (-len(image_base64) % 4)
+    try:
+        head = base64.b64decode(image_base64[:16], validate=True)
+    except (binascii.Error, ValueError):
+        head = b""
+    mime = next((m for sig, m in _IMAGE_SIGNATURES if head.startswith(sig)), "image/png")
+    return f"data:{mime};base64,{image_base64}"
+
 class QASystem:
-    def __init__(self):
-        """Initialize QA System with OpenAI client"""
-        self.client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+    # Kept byte-identical and always sent first so it qualifies for provider-side prompt caching
+    _SYSTEM_PROMPT: ClassVar[str] = """You are a helpful Teaching Assistant for the Tools in Data Science (TDS) course at IIT Madras. 
+Your role is to answer student questions based on the course content and discussion forum posts provided.
+
+Instructions:
+1. Answer questions clearly and directly based on the provided context
+2. If the context doesn't contain enough information, say so honestly
+3. For technical questions, provide specific guidance when possible
+4. Reference the course materials or forum discussions when relevant
+5. Be helpful and encouraging, as you would be as a real TA
+6. If asked about specific models or tools, refer to the exact requirements mentioned in the course
+7. Keep your answers concise but comprehensive
+
+Remember: You are representing the TDS course, so maintain academic standards and provide accurate information based on the course content."""
+    
+    _USER_TEMPLATE: ClassVar[str] = """Based on the following course materials and forum discussions, please answer this student question:
+
+QUESTION: {question}
+
+RELEVANT COURSE MATERIALS AND DISCUSSIONS:
+{context}
+
+Please provide a helpful and accurate answer based on the above information."""
+    
+    def __init__(self, vector_store: VectorStore, client: Optional[AsyncOpenAI] = None):
+        """Initialize QA System with OpenAI client and the vector store to retrieve from"""
+        self.vector_store = vector_store
+        self.client = client or AsyncOpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
         self.model = "gpt-3.5-turbo"
+        self.vision_model = "gpt-4o-mini"  # used for questions with an image
+        self.temperature = 0.7
+        
+        # Semantic cache lives in the vector store's qa_cache collection, partitioned by (model, temperature)
+        self.sem_cache_threshold = 0.92
+        
+        # A top hit closer than this (cosine distance) is a near-duplicate of the question; answer
+        # from it directly (tune against real queries)
+        self.direct_answer_distance = float(os.environ.get('DIRECT_ANSWER_DISTANCE', '0.15'))
+        
+        # Exact-match cache: sha256 of (model, temperature, question, image hash) -> result,
+        # kept for 24h and cleared on re-scrape
+        self._exact_cache: TTLCache = TTLCache(maxsize=2048, ttl=86400)
+        self._exact_cache_lock = threading.Lock()
+        
+        # Paraphrase prefetch on semantic cache misses, capped at 10/min so it never competes with live traffic
+        self.prefetch_model = "gpt-3.5-turbo"
+        self._prefetch_limiter = AsyncLimiter(10, 60)
+        self._prefetch_tasks: set = set()
+        
+        # Workloads larger than this go through the OpenAI Batch API
+        self.batch_threshold = 32
+        self.batch_poll_interval = 30
     
-    def generate_answer(self, question: str, image_base64: Optional[str] = None) -> Dict[str, Any]:
+    async def generate_answer(self, question: str, image_base64: Optional[str] = None) -> Dict[str, Any]:
         """Generate answer for a student question"""
         try:
-            # Import vector_store dynamically to avoid circular imports
-            from vector_store import vector_store
-            
-            # Step 1: Search for relevant context
-            relevant_docs = vector_store.search(question, n_results=5)
-            
-            # Step 2: Prepare context for LLM
-            context = self._prepare_context(relevant_docs)
-            
-            # Step 3: Create system prompt
-            system_prompt = self._create_system_prompt()
-            
-            # Step 4: Create user prompt with context
-            user_prompt = self._create_user_prompt(question, context)
+            cache_key = self._cache_key(question, image_base64)
+            cached = self._exact_cache_get(cache_key)
+            if cached is not None:
+                logger.info(f"Exact cache hit for question: {question[:100]}...")
+                return cached
             
-            # Step 5: Generate response using OpenAI
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ]
+            # Questions with images bypass the semantic cache
+            q_emb = None
+            if not image_base64:
+                q_emb = await asyncio.to_thread(self.vector_store.embed, question)
+                cached = await asyncio.to_thread(self._sem_cache_lookup, question, q_emb)
+                if cached is not None:
+                    logger.info(f"Semantic cache hit for question: {question[:100]}...")
+                    return cached
             
-            # Handle image if provided
-            if image_base64:
-                # For GPT-4 Vision (if available), otherwise describe that image was provided
-                user_prompt += f"\n\nNote: An image was provided with this question (base64 encoded). Please consider this in your response if relevant."
+            # Step 1: Search for relevant context
+            relevant_docs = await self.search(question)
             
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=800
-            )
+            # Near-exact match with no image to consider: the retrieved content is the answer
+            if not image_base64 and self._is_direct_hit(relevant_docs):
+                logger.info(f"Answered from top hit (distance {relevant_docs[0].distance:.3f}): {question[:100]}...")
+                return {"answer": relevant_docs[0].content, "links": self.extract_links(relevant_docs)}
             
-            answer_text = response.choices[0].message.content.strip()
+            # Step 2: Build prompts from the retrieved context
+            messages = self.build_messages(question, relevant_docs, image_base64)
             
-            # Step 6: Extract links from relevant documents
-            links = self._extract_links(relevant_docs)
+            # Step 3: Generate response using OpenAI, sending any image to the vision model
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.vision_model if image_base64 else self.model,
+                    messages=messages,
+                    temperature=self.temperature,
+                    max_tokens=800
+                )
+                answer_text = response.choices[0].message.content.strip()
+            except Exception as openai_error:
+                logger.warning(f"OpenAI API error: {openai_error}")
+                # Fallback response based on the most relevant document; not cached
+                if relevant_docs:
+                    answer_text = f"Based on the course materials, here's what I found: {relevant_docs[0].content[:500]}..."
+                else:
+                    answer_text = "I found some relevant information but couldn't generate a complete response. Please check the course materials linked below."
+                return {"answer": answer_text, "links": self.extract_links(relevant_docs)}
             
-            # Step 7: Format response
+            # Step 4: Format response
             result = {
                 "answer": answer_text,
-                "links": links
+                "links": self.extract_links(relevant_docs)
             }
             
+            if q_emb is not None:
+                await asyncio.to_thread(self._sem_cache_add, question, q_emb, result)
+                task = asyncio.create_task(self.prefetch_paraphrases(question, result))
+                self._prefetch_tasks.add(task)
+                task.add_done_callback(self._prefetch_tasks.discard)
+            self._exact_cache_put(cache_key, result)
+            
             logger.info(f"Generated answer for question: {question[:100]}...")
             return result
             
@@ -71,80 +176,314 @@ class QASystem:
                 "links": []
             }
     
-    def _prepare_context(self, relevant_docs: List[Dict[str, Any]]) -> str:
-        """Prepare context from relevant documents"""
-        context_parts = []
+    async def stream_answer(self, question: str, image_base64: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Answer a student question as events: {"delta": text} chunks, then {"links": [...]}"""
+        cache_key = self._cache_key(question, image_base64)
+        cached = self._exact_cache_get(cache_key)
+        if cached is not None:
+            yield {"delta": cached["answer"]}
+            yield {"links": cached["links"]}
+            return
         
-        for doc in relevant_docs:
-            content = doc.get('content', '')
-            metadata = doc.get('metadata', {})
-            
-            # Format context with metadata
-            context_part = f"Source: {metadata.get('type', 'unknown')}\n"
-            if metadata.get('title'):
-                context_part += f"Title: {metadata.get('title')}\n"
-            if metadata.get('url'):
-                context_part += f"URL: {metadata.get('url')}\n"
-            context_part += f"Content: {content}\n"
-            context_part += "-" * 50 + "\n"
-            
-            context_parts.append(context_part)
+        parts = []
+        links = []
+        try:
+            relevant_docs = await self.search(question)
+            links = self.extract_links(relevant_docs)
+            stream = await self.client.chat.completions.create(
+                model=self.vision_model if image_base64 else self.model,
+                messages=self.build_messages(question, relevant_docs, image_base64),
+                temperature=self.temperature,
+                max_tokens=800,
+                stream=True
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield {"delta": parts[-1]}
+            
+            # A completed stream is as good as a non-streamed answer, so share the cache
+            self._exact_cache_put(cache_key, {"answer": "".join(parts).strip(), "links": links})
+        except Exception as e:
+            logger.error(f"Error streaming answer: {e}")
+            yield {"error": "Failed to generate answer"}
         
-        return "\n".join(context_parts)
+        # Citations come last, once the answer they support has been sent
+        yield {"links": links}
     
-    def _create_system_prompt(self) -> str:
-        """Create system prompt for the LLM"""
-        return """You are a helpful Teaching Assistant for the Tools in Data Science (TDS) course at IIT Madras. 
-Your role is to answer student questions based on the course content and discussion forum posts provided.
-
-Instructions:
-1. Answer questions clearly and directly based on the provided context
-2. If the context doesn't contain enough information, say so honestly
-3. For technical questions, provide specific guidance when possible
-4. Reference the course materials or forum discussions when relevant
-5. Be helpful and encouraging, as you would be as a real TA
-6. If asked about specific models or tools, refer to the exact requirements mentioned in the course
-7. Keep your answers concise but comprehensive
-
-Remember: You are representing the TDS course, so maintain academic standards and provide accurate information based on the course content."""
+    async def prefetch_paraphrases(self, question: str, result: Dict[str, Any]) -> None:
+        """Cache the answer under paraphrases of the question so later rewordings hit the semantic cache"""
+        # Skip rather than queue when over budget
+        if not self._prefetch_limiter.has_capacity():
+            return
+        
+        try:
+            async with self._prefetch_limiter:
+                response = await self.client.chat.completions.create(
+                    model=self.prefetch_model,
+                    messages=[{
+                        "role": "user",
+                        "content": f"Give 5 paraphrases of the following question, one per line, without numbering:\n\n{question}"
+                    }],
+                    temperature=0.7,
+                    max_tokens=300
+                )
+            
+            text = response.choices[0].message.content or ""
+            paraphrases = [line.strip(" -*\t") for line in text.splitlines() if line.strip(" -*\t")][:5]
+            for paraphrase in paraphrases:
+                emb = await asyncio.to_thread(self.vector_store.embed, paraphrase)
+                await asyncio.to_thread(self._sem_cache_add, paraphrase, emb, result)
+            
+            logger.info(f"Prefetched {len(paraphrases)} paraphrases for question: {question[:100]}...")
+            
+        except Exception as e:
+            logger.warning(f"Error prefetching paraphrases: {e}")
     
-    def _create_user_prompt(self, question: str, context: str) -> str:
-        """Create user prompt with question and context"""
-        return f"""Based on the following course materials and forum discussions, please answer this student question:
-
-QUESTION: {question}
-
-RELEVANT COURSE MATERIALS AND DISCUSSIONS:
-{context}
-
-Please provide a helpful and accurate answer based on the above information."""
+    async def generate_answers_batch(self, questions: List[str]) -> List[Dict[str, Any]]:
+        """Answer many questions, using the OpenAI Batch API for large workloads and waiting for it to finish"""
+        if len(questions) <= self.batch_threshold:
+            return list(await asyncio.gather(*[self.generate_answer(q) for q in questions]))
+        
+        try:
+            batch_id, links = await self.submit_batch(questions)
+            while True:
+                status, answers = await self.batch_answers(batch_id)
+                if answers is not None:
+                    break
+                if status in ("failed", "expired", "cancelled"):
+                    raise RuntimeError(f"Batch {batch_id} ended with status {status}")
+                await asyncio.sleep(self.batch_poll_interval)
+            
+            return [
+                {"answer": answers.get(i, "I couldn't generate an answer at this time."), "links": links[i]}
+                for i in range(len(questions))
+            ]
+            
+        except Exception as e:
+            logger.error(f"Error generating batch answers: {e}")
+            return [
+                {
+                    "answer": "I apologize, but I encountered an error while processing your question. Please try again later.",
+                    "links": []
+                }
+                for _ in questions
+            ]
     
-    def _extract_links(self, relevant_docs: List[Dict[str, Any]]) -> List[Dict[str, str]]:
-        """Extract relevant links from documents"""
-        links = []
-        seen_urls = set()
+    async def submit_batch(self, questions: List[str]) -> Tuple[str, List[List[Dict[str, str]]]]:
+        """Submit questions to the OpenAI Batch API, returning the batch id and each question's links"""
+        # Retrieve context for every question and build one JSONL request per question
+        relevant = await asyncio.gather(*[self.search(q) for q in questions])
+        lines = []
+        for i, (question, relevant_docs) in enumerate(zip(questions, relevant)):
+            lines.append(orjson.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "messages": self.build_messages(question, relevant_docs),
+                    "temperature": self.temperature,
+                    "max_tokens": 800
+                }
+            }))
         
-        for doc in relevant_docs:
-            metadata = doc.get('metadata', {})
-            url = metadata.get('url', '')
-            
-            if url and url not in seen_urls:
-                # Create meaningful link text
-                title = metadata.get('title', '')
-                if not title:
-                    title = doc.get('content', '')[:100] + "..." if len(doc.get('content', '')) > 100 else doc.get('content', '')
-                
-                links.append({
-                    "url": url,
-                    "text": title
+        batch_file = await self.client.files.create(
+            file=("questions.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logger.info(f"Submitted batch {batch.id} with {len(questions)} questions")
+        return batch.id, [self.extract_links(docs) for docs in relevant]
+    
+    async def batch_answers(self, batch_id: str) -> Tuple[str, Optional[Dict[int, str]]]:
+        """Status of a submitted batch and, once it has completed, its answers by question index"""
+        batch = await self.client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            return batch.status, None
+        
+        # Map the output lines back to questions by custom_id; requests that all failed leave no output file
+        answers = {}
+        if batch.output_file_id:
+            output = await self.client.files.content(batch.output_file_id)
+            for line in output.text.splitlines():
+                item = orjson.loads(line)
+                response = item.get("response") or {}
+                if response.get("status_code") == 200:
+                    answers[int(item["custom_id"])] = response["body"]["choices"][0]["message"]["content"].strip()
+        return batch.status, answers
+    
+    async def generate_answers_multi(self, questions: List[str], n_results: int = 3) -> List[Dict[str, Any]]:
+        """Answer several related questions with a single chat completion request"""
+        try:
+            # Union each question's top hits, deduplicated, into one shared context
+            searches = await asyncio.gather(*[self.search(q, n_results=n_results) for q in questions])
+            relevant_docs = []
+            seen = set()
+            for docs in searches:
+                for doc in docs:
+                    if doc.content not in seen:
+                        seen.add(doc.content)
+                        relevant_docs.append(doc)
+            
+            numbered = "\n".join(f"Q{i}: {q}" for i, q in enumerate(questions, 1))
+            user_prompt = self._USER_TEMPLATE.format_map(
+                {"question": numbered, "context": self._prepare_context(relevant_docs)}
+            )
+            user_prompt += (
+                '\n\nAnswer each question separately. Reply with a JSON object of the form '
+                '{"answers": [{"q": <question number>, "answer": "...", "cited": ["<url>", ...]}, ...]}.'
+            )
+            
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": self._SYSTEM_PROMPT},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=self.temperature,
+                max_tokens=800,
+                response_format={"type": "json_object"}
+            )
+            
+            # Split the combined reply back into per-question results
+            parsed = orjson.loads(response.choices[0].message.content)
+            by_number = {}
+            for item in parsed.get("answers", []):
+                # Models sometimes number the questions as strings ("1")
+                try:
+                    by_number[int(item.get("q"))] = item
+                except (AttributeError, TypeError, ValueError):
+                    continue
+            all_links = self.extract_links(relevant_docs)
+            results = []
+            for i, docs in enumerate(searches, 1):
+                item = by_number.get(i, {})
+                cited = set(item.get("cited") or [])
+                links = [link for link in all_links if link["url"] in cited] or self.extract_links(docs)
+                results.append({
+                    "answer": item.get("answer") or "I couldn't generate an answer at this time.",
+                    "links": links
                 })
-                seen_urls.add(url)
-                
-                # Limit to maximum 5 links
-                if len(links) >= 5:
-                    break
+            
+            logger.info(f"Generated {len(results)} answers in a single request")
+            return results
+            
+        except Exception as e:
+            logger.error(f"Error generating multi-question answers: {e}")
+            return [
+                {
+                    "answer": "I apologize, but I encountered an error while processing your question. Please try again later.",
+                    "links": []
+                }
+                for _ in questions
+            ]
+    
+    async def search(self, question: str, n_results: int = 5) -> List[RetrievedDoc]:
+        """Search for similar documents; the CPU-bound encode and blocking query run in a worker thread"""
+        return await asyncio.to_thread(self.vector_store.search, question, n_results)
+    
+    def build_messages(self, question: str, relevant_docs: List[RetrievedDoc],
+                       image_base64: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Build the chat messages for a question and its retrieved context"""
+        user_prompt = self._USER_TEMPLATE.format_map(
+            {"question": question, "context": self._prepare_context(relevant_docs)}
+        )
         
-        return links
+        # Send the image itself to the vision model rather than a note that one exists
+        user_content: Any = user_prompt
+        if image_base64:
+            user_content = [
+                {"type": "text", "text": user_prompt},
+                {"type": "image_url", "image_url": {"url": image_data_url(image_base64)}}
+            ]
+        
+        return [
+            {"role": "system", "content": self._SYSTEM_PROMPT},
+            {"role": "user", "content": user_content}
+        ]
+    
+    def extract_links(self, relevant_docs: List[RetrievedDoc]) -> List[Dict[str, str]]:
+        """Extract up to 5 unique source links from the retrieved documents"""
+        seen_urls = set()
+        # Skip docs without a URL or with one already linked, then keep only the first 5
+        unique_docs = (
+            d for d in relevant_docs
+            if d.url and not (d.url in seen_urls or seen_urls.add(d.url))
+        )
+        
+        # Link text is the title, falling back to a content snippet
+        return [
+            {"url": d.url, "text": d.link_text}
+            for d in islice(unique_docs, 5)
+        ]
+    
+    def clear_caches(self) -> None:
+        """Drop cached answers, which refer to the knowledge base as it was when they were generated"""
+        with self._exact_cache_lock:
+            self._exact_cache.clear()
+        self.vector_store.qa_cache_clear()
+    
+    def _cache_key(self, question: str, image_base64: Optional[str]) -> str:
+        """Build the exact-match cache key for a question and optional image"""
+        # Normalized like VectorStore.embed's key, so case and surrounding whitespace don't miss
+        payload = {
+            "m": self.model,
+            "t": self.temperature,
+            "q": question.strip().lower(),
+            "img": hashlib.sha256(image_base64.encode()).hexdigest() if image_base64 else None
+        }
+        return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    
+    def _exact_cache_get(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """Look up an answer in the exact-match cache"""
+        with self._exact_cache_lock:
+            return self._exact_cache.get(cache_key)
+    
+    def _exact_cache_put(self, cache_key: str, result: Dict[str, Any]) -> None:
+        """Store an answer in the exact-match cache"""
+        with self._exact_cache_lock:
+            self._exact_cache[cache_key] = result
+    
+    def _sem_cache_lookup(self, question: str, q_emb: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Return a cached answer for a semantically near-duplicate question"""
+        return self.vector_store.qa_cache_lookup(
+            question,
+            threshold=self.sem_cache_threshold,
+            embedding=q_emb,
+            where={"$and": [{"model": self.model}, {"temperature": self.temperature}]}
+        )
+    
+    def _sem_cache_add(self, question: str, q_emb: np.ndarray, result: Dict[str, Any]) -> None:
+        """Store an answer in the semantic cache"""
+        self.vector_store.qa_cache_add(
+            question,
+            result["answer"],
+            result["links"],
+            embedding=q_emb,
+            metadata={"model": self.model, "temperature": self.temperature}
+        )
+    
+    def _prepare_context(self, relevant_docs: List[RetrievedDoc]) -> str:
+        """Prepare context from relevant documents"""
+        return "\n".join(
+            f"Source: {d.dtype}\n"
+            + (f"Title: {d.title}\n" if d.title else "")
+            + (f"URL: {d.url}\n" if d.url else "")
+            + f"Content: {d.content}\n{_SEP}\n"
+            for d in relevant_docs
+        )
+    
+    def _is_direct_hit(self, relevant_docs: List[RetrievedDoc]) -> bool:
+        """Whether the top search hit is close enough to answer the question without the LLM"""
+        # The threshold is a cosine distance, meaningless against an L2 index; and a forum post
+        # that closely matches the question is as likely to be a student asking it as an answer
+        if not relevant_docs or not self.vector_store.is_cosine:
+            return False
+        top = relevant_docs[0]
+        return top.is_answer and top.distance is not None and top.distance < self.direct_answer_distance
 
-# Global instance
-qa_system = QASystem()
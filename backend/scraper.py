@@ -1,21 +1,47 @@
 import requests
-from bs4 import BeautifulSoup
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from selectolax.parser import HTMLParser
 import re
-from datetime import datetime, timedelta
+import asyncio
+import aiohttp
+from aiolimiter import AsyncLimiter
+from datetime import datetime, timedelta, timezone
 from typing import List, Dict, Any
 import logging
 from urllib.parse import urljoin, urlparse
-import json
+import orjson
+
+try:
+    from .http_retry import RETRY_STATUSES, retry_delay
+except ImportError:
+    from http_retry import RETRY_STATUSES, retry_delay
 
 logger = logging.getLogger(__name__)
 
+_WS_RE = re.compile(r'\s+')
+_TAGS = ("h1", "h2", "h3", "h4", "p", "div", "section")
+_DROP = ("script", "style")
+_TAGS_SELECTOR = ", ".join(_TAGS)
+_DROP_SELECTOR = ", ".join(_DROP)
+
 class TDSScraper:
     def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
+        self.headers = {
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        })
+        }
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        
+        # Pool keep-alive connections and retry transient failures
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+    
+    def close(self) -> None:
+        """Close the underlying HTTP session"""
+        self.session.close()
         
     def scrape_course_content(self, base_url: str = "https://tds.s-anand.net/#/2025-01/") -> List[Dict[str, Any]]:
         """Scrape TDS course content from the main site"""
@@ -26,18 +52,19 @@ class TDSScraper:
             response = self.session.get("https://tds.s-anand.net/")
             response.raise_for_status()
             
-            soup = BeautifulSoup(response.content, 'html.parser')
+            tree = HTMLParser(response.content)
             content_items = []
+            scraped_at = datetime.utcnow().isoformat()
             
             # Extract main sections and content
             # This is a simplified version - in reality we'd need to handle the specific site structure
-            main_content = soup.find('body')
+            main_content = tree.body
             if main_content:
                 # Extract all text content, preserving structure
-                sections = main_content.find_all(['h1', 'h2', 'h3', 'h4', 'p', 'div', 'section'])
+                sections = main_content.css(_TAGS_SELECTOR)
                 
                 for idx, section in enumerate(sections):
-                    text_content = section.get_text(strip=True)
+                    text_content = section.text(strip=True)
                     if text_content and len(text_content) > 20:  # Filter out very short content
                         content_items.append({
                             'id': f"course_content_{idx}",
@@ -45,8 +72,8 @@ class TDSScraper:
                             'title': text_content[:100] + "..." if len(text_content) > 100 else text_content,
                             'content': text_content,
                             'url': base_url,
-                            'section_type': section.name,
-                            'scraped_at': datetime.utcnow().isoformat()
+                            'section_type': section.tag,
+                            'scraped_at': scraped_at
                         })
             
             logger.info(f"Scraped {len(content_items)} course content items")
@@ -56,63 +83,67 @@ class TDSScraper:
             logger.error(f"Error scraping course content: {e}")
             return []
     
-    def scrape_discourse_posts(self, base_url: str = "https://discourse.onlinedegree.iitm.ac.in/c/courses/tds-kb/34") -> List[Dict[str, Any]]:
+    async def scrape_discourse_posts(self, base_url: str = "https://discourse.onlinedegree.iitm.ac.in/c/courses/tds-kb/34") -> List[Dict[str, Any]]:
         """Scrape Discourse posts from TDS forum"""
         try:
             logger.info(f"Scraping Discourse posts from {base_url}")
             
-            # Get the category page first
-            response = self.session.get(f"{base_url}.json")
-            response.raise_for_status()
-            
-            discourse_data = response.json()
-            posts = []
-            
-            # Extract topics from the category
-            if 'topic_list' in discourse_data and 'topics' in discourse_data['topic_list']:
-                for topic in discourse_data['topic_list']['topics']:
+            connector = aiohttp.TCPConnector(limit=20, keepalive_timeout=30)
+            async with aiohttp.ClientSession(connector=connector, headers=self.headers) as session:
+                # Walk the category pages oldest-first so we can stop once past the date range
+                # (Jan 1 - Apr 14, 2025); only in-range topics cost a detail request
+                start_date = datetime(2025, 1, 1, tzinfo=timezone.utc)
+                end_date = datetime(2025, 4, 14, tzinfo=timezone.utc)
+                topics = []
+                seen_ids = set()
+                for page in range(100):
                     try:
-                        # Check if topic is within our date range (Jan 1 - Apr 14, 2025)
-                        created_at = datetime.fromisoformat(topic.get('created_at', '').replace('Z', '+00:00'))
-                        start_date = datetime(2025, 1, 1)
-                        end_date = datetime(2025, 4, 14)
-                        
-                        if not (start_date <= created_at <= end_date):
+                        discourse_data = await self._fetch_json(
+                            session, f"{base_url}.json?page={page}&order=created&ascending=true"
+                        )
+                    except Exception as e:
+                        # Keep the topics already listed rather than losing the whole category
+                        logger.error(f"Error fetching page {page} of {base_url}, stopping there: {e}")
+                        break
+                    page_topics = discourse_data.get('topic_list', {}).get('topics', [])
+                    if not page_topics:
+                        break
+                    
+                    past_end = False
+                    new_topics = 0
+                    for topic in page_topics:
+                        # Overlapping pages would otherwise produce duplicate document ids
+                        if topic.get('id') in seen_ids:
                             continue
+                        seen_ids.add(topic.get('id'))
+                        new_topics += 1
                         
-                        # Get detailed topic content
-                        topic_url = f"https://discourse.onlinedegree.iitm.ac.in/t/{topic['id']}.json"
-                        topic_response = self.session.get(topic_url)
-                        topic_response.raise_for_status()
-                        
-                        topic_data = topic_response.json()
-                        
-                        # Extract posts from the topic
-                        if 'post_stream' in topic_data and 'posts' in topic_data['post_stream']:
-                            for post in topic_data['post_stream']['posts']:
-                                post_content = self._clean_discourse_content(post.get('cooked', ''))
-                                if post_content and len(post_content) > 10:
-                                    posts.append({
-                                        'id': f"discourse_post_{post['id']}",
-                                        'type': 'discourse_post',
-                                        'title': topic.get('title', ''),
-                                        'content': post_content,
-                                        'raw_content': post.get('raw', ''),
-                                        'url': f"https://discourse.onlinedegree.iitm.ac.in/t/{topic['slug']}/{topic['id']}/{post['post_number']}",
-                                        'author': post.get('username', ''),
-                                        'created_at': post.get('created_at', ''),
-                                        'topic_id': topic['id'],
-                                        'post_number': post.get('post_number', 1),
-                                        'scraped_at': datetime.utcnow().isoformat()
-                                    })
-                        
-                        # Small delay to be respectful
-                        time.sleep(0.5)
+                        # Pinned topics sit at the top regardless of sort order
+                        if topic.get('pinned'):
+                            continue
+                        try:
+                            created_at = datetime.fromisoformat(topic.get('created_at', '').replace('Z', '+00:00'))
+                        except ValueError as e:
+                            logger.warning(f"Error processing topic {topic.get('id', 'unknown')}: {e}")
+                            continue
                         
-                    except Exception as e:
-                        logger.warning(f"Error processing topic {topic.get('id', 'unknown')}: {e}")
-                        continue
+                        if created_at > end_date:
+                            past_end = True
+                        elif created_at >= start_date:
+                            topics.append(topic)
+                    
+                    # A page of only repeats means the server ignored the page number
+                    if past_end or not new_topics:
+                        break
+                
+                # Fetch topic details concurrently, paced by a shared rate limit to be respectful
+                semaphore = asyncio.Semaphore(10)
+                limiter = AsyncLimiter(2, 1)
+                results = await asyncio.gather(
+                    *[self._scrape_topic(session, semaphore, limiter, topic) for topic in topics]
+                )
             
+            posts = [post for topic_posts in results for post in topic_posts]
             logger.info(f"Scraped {len(posts)} discourse posts")
             return posts
             
@@ -120,26 +151,75 @@ class TDSScraper:
             logger.error(f"Error scraping discourse posts: {e}")
             return []
     
+    async def _fetch_json(self, session: aiohttp.ClientSession, url: str, max_attempts: int = 4) -> Dict[str, Any]:
+        """Fetch a URL and decode its JSON body, retrying 429/5xx responses and dropped connections"""
+        for attempt in range(1, max_attempts + 1):
+            final = attempt == max_attempts
+            try:
+                async with session.get(url) as response:
+                    if final or response.status not in RETRY_STATUSES:
+                        response.raise_for_status()
+                        return orjson.loads(await response.read())
+                    delay = retry_delay(response.headers.get('Retry-After'), attempt)
+                    reason = f"HTTP {response.status}"
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                # A bad certificate won't fix itself between attempts
+                if final or isinstance(e, aiohttp.ClientSSLError):
+                    raise
+                delay, reason = retry_delay(None, attempt), type(e).__name__
+            
+            logger.warning(f"{reason} from {url}, retrying in {delay:.1f}s (attempt {attempt}/{max_attempts})")
+            await asyncio.sleep(delay)
+    
+    async def _scrape_topic(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                            limiter: AsyncLimiter, topic: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Scrape all posts from a single Discourse topic"""
+        posts = []
+        try:
+            async with semaphore, limiter:
+                topic_url = f"https://discourse.onlinedegree.iitm.ac.in/t/{topic['id']}.json"
+                topic_data = await self._fetch_json(session, topic_url)
+            
+            # Extract posts from the topic
+            scraped_at = datetime.utcnow().isoformat()
+            for post in topic_data.get('post_stream', {}).get('posts', []):
+                post_content = self._clean_discourse_content(post.get('cooked', ''))
+                if post_content and len(post_content) > 10:
+                    posts.append({
+                        'id': f"discourse_post_{post['id']}",
+                        'type': 'discourse_post',
+                        'title': topic.get('title', ''),
+                        'content': post_content,
+                        'raw_content': post.get('raw', ''),
+                        'url': f"https://discourse.onlinedegree.iitm.ac.in/t/{topic['slug']}/{topic['id']}/{post['post_number']}",
+                        'author': post.get('username', ''),
+                        'staff': bool(post.get('staff')),
+                        'created_at': post.get('created_at', ''),
+                        'topic_id': topic['id'],
+                        'post_number': post.get('post_number', 1),
+                        'scraped_at': scraped_at
+                    })
+        except Exception as e:
+            logger.warning(f"Error processing topic {topic.get('id', 'unknown')}: {e}")
+        
+        return posts
+    
     def _clean_discourse_content(self, html_content: str) -> str:
         """Clean HTML content from Discourse posts"""
         if not html_content:
             return ""
         
-        soup = BeautifulSoup(html_content, 'html.parser')
+        tree = HTMLParser(html_content)
         
         # Remove script and style elements
-        for script in soup(["script", "style"]):
-            script.decompose()
+        for node in tree.css(_DROP_SELECTOR):
+            node.decompose()
         
         # Get text content
-        text = soup.get_text()
+        text = tree.body.text(separator=' ') if tree.body else ''
         
         # Clean up whitespace
-        lines = (line.strip() for line in text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        text = ' '.join(chunk for chunk in chunks if chunk)
-        
-        return text
+        return _WS_RE.sub(' ', text).strip()
     
     def get_sample_data(self) -> List[Dict[str, Any]]:
         """Get sample data for testing when actual scraping might fail"""
@@ -174,6 +254,7 @@ class TDSScraper:
                 'raw_content': 'You must use gpt-3.5-turbo-0125, even if the AI Proxy only supports gpt-4o-mini.',
                 'url': 'https://discourse.onlinedegree.iitm.ac.in/t/ga5-question-8-clarification/155939/3',
                 'author': 'ta_helper',
+                'staff': True,
                 'created_at': '2025-03-15T11:00:00Z',
                 'topic_id': 155939,
                 'post_number': 3,
@@ -188,9 +269,19 @@ async def scrape_all_data() -> List[Dict[str, Any]]:
     all_data = []
     
     try:
-        # Try to scrape real data, fall back to sample data if needed
-        course_data = scraper.scrape_course_content()
-        discourse_data = scraper.scrape_discourse_posts()
+        # Try to scrape real data, fall back to sample data if needed.
+        # Both sources are independent, so fetch them concurrently.
+        course_data, discourse_data = await asyncio.gather(
+            asyncio.to_thread(scraper.scrape_course_content),
+            scraper.scrape_discourse_posts(),
+            return_exceptions=True
+        )
+        if isinstance(course_data, BaseException):
+            logger.error(f"Error scraping course content: {course_data}")
+            course_data = []
+        if isinstance(discourse_data, BaseException):
+            logger.error(f"Error scraping discourse posts: {discourse_data}")
+            discourse_data = []
         
         # If no real data, use sample data
         if not course_data and not discourse_data:
@@ -203,5 +294,7 @@ async def scrape_all_data() -> List[Dict[str, Any]]:
         logger.error(f"Error in scrape_all_data: {e}")
         # Use sample data as fallback
         all_data = scraper.get_sample_data()
+    finally:
+        scraper.close()
     
     return all_data
@@ -1,12 +1,19 @@
-from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks
+import os
+
+# Cap BLAS/OpenMP pools before numpy and the embedding runtime load them; each worker
+# sizes its own inference pool in load_embedding_model instead of one thread per core
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+os.environ.setdefault('MKL_NUM_THREADS', '1')
+
+from fastapi import FastAPI, APIRouter, HTTPException, BackgroundTasks, Response, Query
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
-import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Optional, Union
 import uuid
 from datetime import datetime
 import base64
@@ -16,10 +23,11 @@ import time
 import re
 from urllib.parse import urljoin, urlparse
 import json
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
-from openai import OpenAI
+import asyncio
+import orjson
+from vector_store import VectorStore
+from qa_system import QASystem
+from async_llm import run_batch
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -30,7 +38,11 @@ client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
-app = FastAPI(title="TDS Virtual Teaching Assistant", version="1.0.0")
+app = FastAPI(
+    title="TDS Virtual Teaching Assistant",
+    version="1.0.0",
+    default_response_class=ORJSONResponse
+)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
@@ -42,20 +54,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-
-# Initialize ChromaDB
+# Neither ChromaDB's SQLite handles nor ONNX Runtime sessions survive fork, so each worker
+# builds its own VectorStore (and embedding model) and the QASystem answering from it in the
+# startup hook (stored on app.state)
 persist_directory = "/app/backend/chroma_db"
-os.makedirs(persist_directory, exist_ok=True)
-chroma_client = chromadb.PersistentClient(path=persist_directory)
-collection = chroma_client.get_or_create_collection(
-    name="tds_knowledge_base",
-    metadata={"description": "TDS course content and discourse posts"}
-)
-
-# Initialize embedding model
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
 
 # Define Models
 class StatusCheck(BaseModel):
@@ -78,13 +80,40 @@ class QuestionResponse(BaseModel):
     answer: str
     links: List[Link]
 
+# Questions accepted per bulk request
+MAX_BULK_QUESTIONS = 500
+
+class BulkQuestionRequest(BaseModel):
+    questions: List[str] = Field(..., min_length=1, max_length=MAX_BULK_QUESTIONS)
+
+# Related questions answered together in one chat completion
+MAX_RELATED_QUESTIONS = 5
+
+class RelatedQuestionsRequest(BaseModel):
+    questions: List[str] = Field(..., min_length=1, max_length=MAX_RELATED_QUESTIONS)
+
+class BulkQuestionResponse(BaseModel):
+    results: List[QuestionResponse]
+
+class BulkJobResponse(BaseModel):
+    batch_id: str
+    status: str
+    results: Optional[List[QuestionResponse]] = None
+
 class DataScrapeResponse(BaseModel):
     status: str
     message: str
     total_documents: int
 
-# Global flag to track if data has been loaded
+# Global flag to track if data has been loaded, and why the last initialization failed
 data_loaded = False
+init_error: Optional[str] = None
+init_lock = asyncio.Lock()
+init_task: Optional[asyncio.Task] = None
+
+# Initialization attempts per run, backing off between them; a request arriving after a run
+# has given up starts another
+INIT_MAX_ATTEMPTS = 5
 
 def get_sample_data():
     """Get sample data for testing"""
@@ -119,6 +148,7 @@ def get_sample_data():
             'raw_content': 'You must use gpt-3.5-turbo-0125, even if the AI Proxy only supports gpt-4o-mini.',
             'url': 'https://discourse.onlinedegree.iitm.ac.in/t/ga5-question-8-clarification/155939/3',
             'author': 'ta_helper',
+            'staff': True,
             'created_at': '2025-03-15T11:00:00Z',
             'topic_id': 155939,
             'post_number': 3,
@@ -144,292 +174,219 @@ def get_sample_data():
         }
     ]
 
-def add_documents_to_vectorstore(documents):
-    """Add documents to the vector store"""
-    try:
-        if not documents:
-            logger.warning("No documents to add")
-            return
-        
-        # Prepare data for ChromaDB
-        ids = []
-        embeddings = []
-        metadatas = []
-        documents_text = []
-        
-        for doc in documents:
-            doc_id = doc.get('id', str(uuid.uuid4()))
-            content = doc.get('content', '')
-            
-            # Skip if no content
-            if not content.strip():
-                continue
-            
-            # Generate embedding
-            embedding = embedding_model.encode(content).tolist()
-            
-            # Prepare metadata (ChromaDB requires all values to be strings, ints, or floats)
-            metadata = {
-                'type': str(doc.get('type', 'unknown')),
-                'title': str(doc.get('title', ''))[:500],  # Limit length
-                'url': str(doc.get('url', '')),
-                'scraped_at': str(doc.get('scraped_at', '')),
-            }
-            
-            # Add specific fields based on document type
-            if doc.get('type') == 'discourse_post':
-                metadata.update({
-                    'author': str(doc.get('author', '')),
-                    'topic_id': str(doc.get('topic_id', '')),
-                    'post_number': str(doc.get('post_number', ''))
-                })
-            elif doc.get('type') == 'course_content':
-                metadata.update({
-                    'section_type': str(doc.get('section_type', ''))
-                })
-            
-            ids.append(doc_id)
-            embeddings.append(embedding)
-            metadatas.append(metadata)
-            documents_text.append(content)
-        
-        if ids:
-            # Add to ChromaDB
-            collection.add(
-                ids=ids,
-                embeddings=embeddings,
-                metadatas=metadatas,
-                documents=documents_text
-            )
-            
-            logger.info(f"Added {len(ids)} documents to vector store")
-        else:
-            logger.warning("No valid documents to add")
-            
-    except Exception as e:
-        logger.error(f"Error adding documents to vector store: {e}")
-        raise
-
-def search_vectorstore(query: str, n_results: int = 5):
-    """Search for similar documents"""
-    try:
-        # Generate query embedding
-        query_embedding = embedding_model.encode(query).tolist()
-        
-        # Search in ChromaDB
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=n_results,
-            include=['documents', 'metadatas', 'distances']
-        )
-        
-        # Format results
-        formatted_results = []
-        if results['documents'] and results['documents'][0]:
-            for i in range(len(results['documents'][0])):
-                result = {
-                    'content': results['documents'][0][i],
-                    'metadata': results['metadatas'][0][i],
-                    'distance': results['distances'][0][i] if results['distances'] else None
-                }
-                formatted_results.append(result)
-        
-        logger.info(f"Found {len(formatted_results)} results for query: {query[:100]}...")
-        return formatted_results
-        
-    except Exception as e:
-        logger.error(f"Error searching vector store: {e}")
-        return []
-
-def generate_answer(question: str, image_base64: Optional[str] = None):
-    """Generate answer for a student question"""
-    try:
-        # Step 1: Search for relevant context
-        relevant_docs = search_vectorstore(question, n_results=5)
-        
-        # Step 2: Prepare context for LLM
-        context_parts = []
-        for doc in relevant_docs:
-            content = doc.get('content', '')
-            metadata = doc.get('metadata', {})
-            
-            # Format context with metadata
-            context_part = f"Source: {metadata.get('type', 'unknown')}\n"
-            if metadata.get('title'):
-                context_part += f"Title: {metadata.get('title')}\n"
-            if metadata.get('url'):
-                context_part += f"URL: {metadata.get('url')}\n"
-            context_part += f"Content: {content}\n"
-            context_part += "-" * 50 + "\n"
-            
-            context_parts.append(context_part)
-        
-        context = "\n".join(context_parts)
-        
-        # Step 3: Create system prompt
-        system_prompt = """You are a helpful Teaching Assistant for the Tools in Data Science (TDS) course at IIT Madras. 
-Your role is to answer student questions based on the course content and discussion forum posts provided.
-
-Instructions:
-1. Answer questions clearly and directly based on the provided context
-2. If the context doesn't contain enough information, say so honestly
-3. For technical questions, provide specific guidance when possible
-4. Reference the course materials or forum discussions when relevant
-5. Be helpful and encouraging, as you would be as a real TA
-6. If asked about specific models or tools, refer to the exact requirements mentioned in the course
-7. Keep your answers concise but comprehensive
-
-Remember: You are representing the TDS course, so maintain academic standards and provide accurate information based on the course content."""
-        
-        # Step 4: Create user prompt with context
-        user_prompt = f"""Based on the following course materials and forum discussions, please answer this student question:
-
-QUESTION: {question}
-
-RELEVANT COURSE MATERIALS AND DISCUSSIONS:
-{context}
-
-Please provide a helpful and accurate answer based on the above information."""
-        
-        # Handle image if provided
-        if image_base64:
-            user_prompt += f"\n\nNote: An image was provided with this question (base64 encoded). Please consider this in your response if relevant."
-        
-        # Step 5: Generate response using OpenAI
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        
-        try:
-            response = openai_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                temperature=0.7,
-                max_tokens=800
-            )
-            
-            answer_text = response.choices[0].message.content.strip()
-        except Exception as openai_error:
-            logger.warning(f"OpenAI API error: {openai_error}")
-            # Fallback response based on retrieved context
-            if relevant_docs:
-                # Use the most relevant document as fallback
-                best_doc = relevant_docs[0]
-                answer_text = f"Based on the course materials, here's what I found: {best_doc['content'][:500]}..."
-            else:
-                answer_text = "I found some relevant information but couldn't generate a complete response. Please check the course materials linked below."
-        
-        # Step 6: Extract links from relevant documents
-        links = []
-        seen_urls = set()
-        
-        for doc in relevant_docs:
-            metadata = doc.get('metadata', {})
-            url = metadata.get('url', '')
-            
-            if url and url not in seen_urls:
-                # Create meaningful link text
-                title = metadata.get('title', '')
-                if not title:
-                    title = doc.get('content', '')[:100] + "..." if len(doc.get('content', '')) > 100 else doc.get('content', '')
-                
-                links.append({
-                    "url": url,
-                    "text": title
-                })
-                seen_urls.add(url)
-                
-                # Limit to maximum 5 links
-                if len(links) >= 5:
-                    break
-        
-        # Step 7: Format response
-        result = {
-            "answer": answer_text,
-            "links": links
-        }
-        
-        logger.info(f"Generated answer for question: {question[:100]}...")
-        return result
-        
-    except Exception as e:
-        logger.error(f"Error generating answer: {e}")
-        return {
-            "answer": "I apologize, but I encountered an error while processing your question. Please try again later.",
-            "links": []
-        }
-
 # Background task to initialize data
 async def initialize_data():
-    """Initialize vector store with scraped data"""
-    global data_loaded
-    try:
-        logger.info("Starting data initialization...")
-        
-        # Check if data already exists
-        count = collection.count()
-        if count > 0:
-            logger.info(f"Data already exists: {count} documents")
-            data_loaded = True
-            return
-        
-        # Use sample data for now
-        all_data = get_sample_data()
+    """Initialize vector store with scraped data, retrying with backoff if it fails"""
+    global data_loaded, init_error
+    for attempt in range(1, INIT_MAX_ATTEMPTS + 1):
+        # Serialize runs so startup and /scrape-data can't ingest concurrently
+        async with init_lock:
+            try:
+                logger.info("Starting data initialization...")
+                
+                vector_store = app.state.vector_store
+                
+                # Re-ingest a knowledge base indexed with outdated HNSW settings before serving from it
+                await asyncio.to_thread(vector_store.rebuild_outdated_index)
+                
+                # Check if data already exists
+                count = vector_store.collection.count()
+                if count > 0:
+                    logger.info(f"Data already exists: {count} documents")
+                    data_loaded, init_error = True, None
+                    return
+                
+                # Use sample data for now
+                all_data = get_sample_data()
+                
+                if all_data:
+                    # Add to vector store off the event loop
+                    await asyncio.to_thread(vector_store.add_documents, all_data)
+                    data_loaded, init_error = True, None
+                    logger.info(f"Successfully initialized with {len(all_data)} documents")
+                else:
+                    logger.warning("No data was loaded")
+                return
+                
+            except Exception as e:
+                init_error = str(e)
+                logger.error(f"Error initializing data (attempt {attempt}/{INIT_MAX_ATTEMPTS}): {e}")
         
-        if all_data:
-            # Add to vector store
-            add_documents_to_vectorstore(all_data)
-            data_loaded = True
-            logger.info(f"Successfully initialized with {len(all_data)} documents")
-        else:
-            logger.warning("No data was loaded")
-            
-    except Exception as e:
-        logger.error(f"Error initializing data: {e}")
+        if attempt < INIT_MAX_ATTEMPTS:
+            await asyncio.sleep(min(2 ** attempt, 60))
+
+def require_data_loaded() -> None:
+    """Reject a request with 503 until the knowledge base is ready"""
+    global init_task
+    if data_loaded:
+        return
+    
+    # Data loads in the background from startup; if that run gave up, start another rather
+    # than staying unavailable until a restart
+    if init_task is None or init_task.done():
+        init_task = asyncio.create_task(initialize_data())
+    
+    detail = "Knowledge base not initialized"
+    if init_error:
+        detail += f" (last attempt failed: {init_error})"
+    raise HTTPException(status_code=503, detail=detail)
 
 # Add your routes to the router instead of directly to app
 @api_router.get("/")
 async def root():
     return {"message": "TDS Virtual Teaching Assistant API", "status": "running"}
 
-@api_router.post("/", response_model=QuestionResponse)
+# Hot path: return plain dicts through ORJSONResponse instead of validating them into
+# QuestionResponse/Link models; the model is still advertised in the OpenAPI schema
+@api_router.post("/", response_model=None, responses={200: {"model": QuestionResponse}})
 async def answer_question(request: QuestionRequest):
     """Main endpoint to answer student questions"""
+    # Outside the try below, which would turn the 503 into a 500
+    require_data_loaded()
+    
     try:
-        # Ensure data is loaded
-        if not data_loaded:
-            await initialize_data()
+        # Generate answer
+        result = await app.state.qa_system.generate_answer(request.question, request.image)
         
-        if not data_loaded:
-            raise HTTPException(status_code=503, detail="Knowledge base not initialized")
+        return ORJSONResponse({
+            "answer": result.get("answer", "I couldn't generate an answer at this time."),
+            "links": result.get("links", [])
+        })
         
-        # Generate answer
-        result = generate_answer(request.question, request.image)
+    except Exception as e:
+        logger.error(f"Error answering question: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@api_router.post("/stream")
+async def answer_question_stream(request: QuestionRequest):
+    """Answer a student question as a Server-Sent Events stream: answer deltas, then the links"""
+    require_data_loaded()
+    
+    async def events():
+        async for event in app.state.qa_system.stream_answer(request.question, request.image):
+            yield b"data: " + orjson.dumps(event) + b"\n\n"
+        yield b"data: [DONE]\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@api_router.post(
+    "/bulk-answer",
+    response_model=Union[BulkQuestionResponse, BulkJobResponse],
+    responses={202: {"model": BulkJobResponse}}
+)
+async def bulk_answer(request: BulkQuestionRequest, response: Response):
+    """
+    Answer a list of questions
+    
+    Small lists are answered in the response. Larger ones are submitted to the OpenAI Batch API,
+    which can take up to 24h, so they get a 202 with a batch id to poll at /bulk-answer/{batch_id}.
+    """
+    require_data_loaded()
+    
+    qa_system = app.state.qa_system
+    try:
+        if len(request.questions) <= qa_system.batch_threshold:
+            results = await qa_system.generate_answers_batch(request.questions)
+            return BulkQuestionResponse(results=[
+                QuestionResponse(
+                    answer=result.get("answer", "I couldn't generate an answer at this time."),
+                    links=[Link(url=link["url"], text=link["text"]) for link in result.get("links", [])]
+                )
+                for result in results
+            ])
         
-        # Format response
-        links = [Link(url=link["url"], text=link["text"]) for link in result.get("links", [])]
+        # Links are resolved now, against the knowledge base the prompts were built from, and
+        # kept in Mongo so any worker can serve the status route
+        batch_id, links = await qa_system.submit_batch(request.questions)
+        await db.bulk_jobs.insert_one({"batch_id": batch_id, "links": links, "created_at": datetime.utcnow()})
+        response.status_code = 202
+        return BulkJobResponse(batch_id=batch_id, status="submitted")
         
-        return QuestionResponse(
-            answer=result.get("answer", "I couldn't generate an answer at this time."),
-            links=links
+    except Exception as e:
+        logger.error(f"Error answering bulk questions: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@api_router.get("/bulk-answer/{batch_id}", response_model=BulkJobResponse)
+async def bulk_answer_status(batch_id: str):
+    """Status of a batched bulk request, with its answers once the batch has completed"""
+    job = await db.bulk_jobs.find_one({"batch_id": batch_id}, {"links": 1, "_id": 0})
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown batch id")
+    
+    try:
+        status, answers = await app.state.qa_system.batch_answers(batch_id)
+    except Exception as e:
+        logger.error(f"Error checking batch {batch_id}: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    
+    if answers is None:
+        return BulkJobResponse(batch_id=batch_id, status=status)
+    return BulkJobResponse(batch_id=batch_id, status=status, results=[
+        QuestionResponse(
+            answer=answers.get(i, "I couldn't generate an answer at this time."),
+            links=[Link(url=link["url"], text=link["text"]) for link in links]
+        )
+        for i, links in enumerate(job["links"])
+    ])
+
+@api_router.post("/batch-ask", response_model=BulkQuestionResponse)
+async def batch_ask(request: BulkQuestionRequest):
+    """Answer a list of questions concurrently within the OpenAI rate limits"""
+    require_data_loaded()
+    
+    try:
+        qa_system = app.state.qa_system
+        relevant = await asyncio.gather(*[qa_system.search(q) for q in request.questions])
+        answers = await run_batch(
+            [qa_system.build_messages(q, docs) for q, docs in zip(request.questions, relevant)],
+            model=qa_system.model,
+            rpm=int(os.environ['OPENAI_MAX_RPM']) if os.environ.get('OPENAI_MAX_RPM') else None,
+            tpm=int(os.environ['OPENAI_MAX_TPM']) if os.environ.get('OPENAI_MAX_TPM') else None,
+            temperature=qa_system.temperature,
+            client=qa_system.client
         )
+        return BulkQuestionResponse(results=[
+            QuestionResponse(
+                answer=answer or "I couldn't generate an answer at this time.",
+                links=[Link(url=link["url"], text=link["text"]) for link in qa_system.extract_links(docs)]
+            )
+            for answer, docs in zip(answers, relevant)
+        ])
         
     except Exception as e:
-        logger.error(f"Error answering question: {e}")
+        logger.error(f"Error answering batch questions: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@api_router.post("/ask-related", response_model=BulkQuestionResponse)
+async def ask_related(request: RelatedQuestionsRequest):
+    """Answer a few related questions, e.g. follow-ups from one thread, in a single chat completion"""
+    require_data_loaded()
+    
+    try:
+        results = await app.state.qa_system.generate_answers_multi(request.questions)
+        return BulkQuestionResponse(results=[
+            QuestionResponse(
+                answer=result["answer"],
+                links=[Link(url=link["url"], text=link["text"]) for link in result["links"]]
+            )
+            for result in results
+        ])
+        
+    except Exception as e:
+        logger.error(f"Error answering related questions: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @api_router.post("/scrape-data", response_model=DataScrapeResponse)
 async def scrape_data_endpoint(background_tasks: BackgroundTasks):
     """Endpoint to trigger data scraping (useful for testing)"""
     try:
-        # Clear existing data
-        chroma_client.delete_collection(name="tds_knowledge_base")
-        global collection
-        collection = chroma_client.get_or_create_collection(
-            name="tds_knowledge_base",
-            metadata={"description": "TDS course content and discourse posts"}
-        )
+        # Clear existing data off the event loop; holding init_lock keeps the clear from
+        # interleaving with an ingest that is still running
+        async with init_lock:
+            await asyncio.to_thread(app.state.vector_store.clear_collection)
+            
+            # Cached answers refer to the old knowledge base
+            await asyncio.to_thread(app.state.qa_system.clear_caches)
         
         # Trigger background scraping
         background_tasks.add_task(initialize_data)
@@ -448,10 +405,11 @@ async def scrape_data_endpoint(background_tasks: BackgroundTasks):
 async def get_status():
     """Get system status"""
     try:
-        count = collection.count()
+        count = app.state.vector_store.count()
         return {
             "status": "running",
             "data_loaded": data_loaded,
+            "init_error": init_error,
             "total_documents": count,
             "openai_configured": bool(os.environ.get('OPENAI_API_KEY'))
         }
@@ -466,10 +424,18 @@ async def create_status_check(input: StatusCheckCreate):
     _ = await db.status_checks.insert_one(status_obj.dict())
     return status_obj
 
-@api_router.get("/status-checks", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
-    return [StatusCheck(**status_check) for status_check in status_checks]
+@api_router.get("/status-checks", response_model=None)
+async def get_status_checks(limit: int = Query(100, ge=1, le=1000)):
+    """Stream the most recent status checks as NDJSON"""
+    async def stream():
+        # Documents were written from StatusCheck, so serialize them as-is without re-validating
+        cursor = db.status_checks.find(
+            {}, {"id": 1, "client_name": 1, "timestamp": 1, "_id": 0}
+        ).sort("timestamp", -1).limit(limit).batch_size(50)
+        async for status_check in cursor:
+            yield orjson.dumps(status_check) + b"\n"
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -487,11 +453,20 @@ app.add_middleware(
 async def startup_event():
     """Initialize data on startup"""
     logger.info("Starting TDS Virtual Teaching Assistant API")
-    # Initialize data in background
+    app.state.vector_store = await asyncio.to_thread(VectorStore, persist_directory)
+    app.state.qa_system = QASystem(app.state.vector_store)
+    try:
+        await asyncio.to_thread(app.state.vector_store.warm_up)
+    except Exception as e:
+        logger.error(f"Error warming up embedding model: {e}")
     try:
-        await initialize_data()
+        await db.status_checks.create_index("timestamp")
+        await db.bulk_jobs.create_index("batch_id", unique=True)
     except Exception as e:
-        logger.error(f"Error during startup initialization: {e}")
+        logger.error(f"Error creating indexes: {e}")
+    # Initialize data in background so startup and readiness aren't blocked on ingestion
+    global init_task
+    init_task = asyncio.create_task(initialize_data())
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
@@ -1,17 +1,136 @@
 import chromadb
 from chromadb.config import Settings
 import os
+import fcntl
+import contextlib
 import logging
+import platform
 from typing import List, Dict, Any, Optional
 import uuid
+import functools
+import json
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from sentence_transformers import SentenceTransformer
 import numpy as np
 
 logger = logging.getLogger(__name__)
 
+# HNSW settings for the knowledge base: cosine space over normalized MiniLM embeddings,
+# with a denser graph and wider search than ChromaDB's defaults for better recall
+COLLECTION_METADATA = {
+    "description": "TDS course content and discourse posts",
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 64
+}
+COLLECTION_NAME = "tds_knowledge_base"
+
+# ChromaDB fixes these when a collection is created, using its defaults for any not given
+_INDEX_DEFAULTS = {"hnsw:space": "l2", "hnsw:M": 16, "hnsw:construction_ef": 100, "hnsw:search_ef": 10}
+
+def embedding_threads() -> int:
+    """
+    Inference threads per worker process
+    
+    Splits the cores between the server workers (UVICORN_WORKERS, or WEB_CONCURRENCY
+    as exported by gunicorn.conf.py's post_fork hook) so concurrent encodes don't
+    oversubscribe the CPU
+    """
+    workers = int(os.environ.get('UVICORN_WORKERS') or os.environ.get('WEB_CONCURRENCY') or 1)
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+def _load_torch_model(model_name: str, threads: int) -> SentenceTransformer:
+    """Load the FP32 PyTorch model with its intra-op thread pool capped"""
+    import torch
+    torch.set_num_threads(threads)
+    return SentenceTransformer(model_name)
+
+def load_embedding_model(model_name: str = 'all-MiniLM-L6-v2') -> SentenceTransformer:
+    """
+    Load the embedding model on the backend selected by EMBEDDING_BACKEND
+    
+    onnx (default) and openvino use INT8-quantized graphs for CPU deployments;
+    torch keeps the FP32 PyTorch model, e.g. for GPU boxes. Falls back to PyTorch
+    if the selected backend can't be loaded. Every backend runs on embedding_threads()
+    threads.
+    """
+    backend = os.environ.get('EMBEDDING_BACKEND', 'onnx').lower()
+    threads = embedding_threads()
+    
+    if backend == 'openvino':
+        model_kwargs = {
+            'file_name': 'openvino/openvino_model_qint8_quantized.xml',
+            'ov_config': {'INFERENCE_NUM_THREADS': str(threads)}
+        }
+    elif backend == 'onnx':
+        machine = platform.machine().lower()
+        if machine in ('arm64', 'aarch64'):
+            model_kwargs = {'file_name': 'onnx/model_qint8_arm64.onnx'}
+        else:
+            model_kwargs = {'file_name': 'onnx/model_qint8_avx512_vnni.onnx'}
+        
+        try:
+            import onnxruntime as ort
+            session_options = ort.SessionOptions()
+            session_options.intra_op_num_threads = threads
+            session_options.inter_op_num_threads = 1
+            model_kwargs['session_options'] = session_options
+        except ImportError:
+            logger.warning("onnxruntime is not installed, using PyTorch")
+            return _load_torch_model(model_name, threads)
+    else:
+        return _load_torch_model(model_name, threads)
+    
+    try:
+        return SentenceTransformer(model_name, backend=backend, model_kwargs=model_kwargs)
+    except Exception as e:
+        logger.warning(f"Could not load {backend} embedding model, using PyTorch: {e}")
+        return _load_torch_model(model_name, threads)
+
+def _epoch_seconds(timestamp: Any) -> Optional[int]:
+    """Convert an ISO-8601 timestamp (or datetime) to integer epoch seconds, None if unparseable"""
+    if isinstance(timestamp, str) and timestamp:
+        try:
+            timestamp = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if isinstance(timestamp, datetime):
+        # Naive values come from datetime.utcnow() in the scraper
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return int(timestamp.timestamp())
+    return None
+
+@dataclass(slots=True)
+class RetrievedDoc:
+    """A document returned from a vector store search"""
+    content: str
+    url: str
+    title: str
+    dtype: str
+    distance: Optional[float] = None
+    staff: bool = False
+
+    @property
+    def link_text(self) -> str:
+        """Title for a source link, falling back to the first 100 characters of the content"""
+        if self.title:
+            return self.title
+        snippet = self.content[:100]
+        return snippet + "..." if len(snippet) < len(self.content) else snippet
+
+    @property
+    def is_answer(self) -> bool:
+        """Whether the document answers rather than asks: course content or a staff forum post"""
+        return self.dtype == 'course_content' or self.staff
+
 class VectorStore:
-    def __init__(self, persist_directory: str = "/app/backend/chroma_db"):
-        """Initialize ChromaDB vector store"""
+    def __init__(self, persist_directory: str = "/app/backend/chroma_db",
+                 embedding_model: Optional[SentenceTransformer] = None):
+        """Initialize ChromaDB vector store, reusing an already loaded embedding model if given"""
         self.persist_directory = persist_directory
         
         # Ensure directory exists
@@ -20,16 +139,139 @@ class VectorStore:
         # Initialize ChromaDB client with persistence
         self.client = chromadb.PersistentClient(path=persist_directory)
         
-        # Get or create collection
+        # Get or create collection; an existing one keeps the index settings it was created with
         self.collection = self.client.get_or_create_collection(
-            name="tds_knowledge_base",
-            metadata={"description": "TDS course content and discourse posts"}
+            name=COLLECTION_NAME,
+            metadata=COLLECTION_METADATA
+        )
+        if self.index_outdated:
+            logger.warning(f"{COLLECTION_NAME} was built with {self._index_settings()}; "
+                           f"it will be rebuilt by rebuild_outdated_index()")
+        
+        # Semantic answer cache, persisted across restarts. Each worker's client loads its own copy
+        # of the HNSW index, so entries added by other workers only show up after a restart
+        self.qa_cache = self.client.get_or_create_collection(
+            name="qa_cache",
+            metadata={"hnsw:space": "cosine", "description": "Cached answers keyed by question embedding"}
         )
+        self.qa_cache_ttl = 7 * 24 * 3600
+        
+        # Row cap enforced on every add by evicting the oldest entries; expired rows are purged
+        # at most every qa_cache_purge_interval seconds
+        self.qa_cache_max_entries = 10000
+        self.qa_cache_purge_interval = 3600
+        self._qa_cache_purged_at = 0.0
         
         # Initialize embedding model
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+        self.model_name = 'all-MiniLM-L6-v2'
+        self.embedding_model = embedding_model or load_embedding_model(self.model_name)
+        
+        # Per-instance LRU of text -> float32 embedding bytes (ndarrays aren't hashable or immutable)
+        self._embed_bytes = functools.lru_cache(maxsize=4096)(self._encode_bytes)
+        
+        # Document count kept in memory so status checks don't run COUNT(*) on Chroma's SQLite;
+        # refreshed from the collection at most every count_refresh_interval seconds to pick up
+        # writes made by other workers
+        self.count_refresh_interval = 60
+        self._doc_count = self.collection.count()
+        self._doc_count_at = time.monotonic()
+        
+        logger.info(f"Initialized VectorStore with {self._doc_count} documents")
+    
+    def _encode_bytes(self, text: str) -> bytes:
+        """Encode text to normalized float32 embedding bytes"""
+        embedding = self.embedding_model.encode(text, normalize_embeddings=True)
+        return np.asarray(embedding, dtype=np.float32).tobytes()
+    
+    def embed(self, text: str) -> np.ndarray:
+        """Get the normalized embedding for a text, memoized for repeated queries"""
+        # MiniLM is uncased, so normalizing the key doesn't change the embedding
+        embedding = np.frombuffer(self._embed_bytes(text.strip().lower()), dtype=np.float32)
+        info = self._embed_bytes.cache_info()
+        logger.debug(f"Query embedding cache: {info.hits} hits, {info.misses} misses")
+        return embedding
+    
+    def set_embedding_model(self, model_name: str) -> None:
+        """Swap the embedding model and drop embeddings cached from the old one"""
+        self.model_name = model_name
+        self.embedding_model = load_embedding_model(model_name)
+        self._embed_bytes.cache_clear()
+    
+    @property
+    def index_outdated(self) -> bool:
+        """Whether the collection's HNSW index was built with other settings than COLLECTION_METADATA"""
+        current = self._index_settings()
+        return any(current[key] != COLLECTION_METADATA[key] for key in _INDEX_DEFAULTS)
+    
+    def _index_settings(self) -> Dict[str, Any]:
+        """The HNSW settings the collection was created with"""
+        metadata = self.collection.metadata or {}
+        return {key: metadata.get(key, default) for key, default in _INDEX_DEFAULTS.items()}
+    
+    @property
+    def is_cosine(self) -> bool:
+        """Whether search distances are cosine distances"""
+        return self._index_settings()["hnsw:space"] == "cosine"
+    
+    @contextlib.contextmanager
+    def _rebuild_lock(self):
+        """Exclusive lock shared by every worker process using this persist directory"""
+        with open(os.path.join(self.persist_directory, ".rebuild.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def rebuild_outdated_index(self) -> bool:
+        """
+        Re-ingest the collection under COLLECTION_METADATA if its index was built with other settings
         
-        logger.info(f"Initialized VectorStore with {self.collection.count()} documents")
+        Deployments created before the cosine/HNSW settings were introduced keep their L2 index,
+        since get_or_create_collection never changes an existing collection. The stored documents
+        are re-embedded into a fresh collection that then replaces the old one. Returns whether a
+        rebuild happened.
+        """
+        with self._rebuild_lock():
+            # Another worker may have rebuilt it while this one waited for the lock
+            self.collection = self.client.get_or_create_collection(name=COLLECTION_NAME, metadata=COLLECTION_METADATA)
+            if not self.index_outdated:
+                return False
+            
+            logger.warning(f"Rebuilding {COLLECTION_NAME} ({self._index_settings()}) with {COLLECTION_METADATA}")
+            rebuild_name = f"{COLLECTION_NAME}_rebuild"
+            with contextlib.suppress(Exception):
+                self.client.delete_collection(rebuild_name)  # left over from an interrupted rebuild
+            rebuilt = self.client.create_collection(name=rebuild_name, metadata=COLLECTION_METADATA)
+            
+            offset = 0
+            while True:
+                batch = self.collection.get(limit=5000, offset=offset, include=['documents', 'metadatas'])
+                if not batch['ids']:
+                    break
+                rebuilt.add(
+                    ids=batch['ids'],
+                    embeddings=self._encode_documents(batch['documents']),
+                    metadatas=batch['metadatas'],
+                    documents=batch['documents']
+                )
+                offset += len(batch['ids'])
+            
+            self.client.delete_collection(COLLECTION_NAME)
+            rebuilt.modify(name=COLLECTION_NAME)
+            self.collection = rebuilt
+            self._doc_count = offset
+            self._doc_count_at = time.monotonic()
+            logger.info(f"Rebuilt {COLLECTION_NAME} with {offset} documents")
+            return True
+    
+    def warm_up(self) -> None:
+        """Run throwaway encodes so graph optimization and kernel setup don't land on the first user query"""
+        start = time.perf_counter()
+        self.embedding_model.encode(['warmup'] * 4, batch_size=4, show_progress_bar=False)
+        # A query-length input (~128 tokens) as well, so shape-specialized kernels are ready
+        self.embedding_model.encode([' '.join(['assignment'] * 120)], show_progress_bar=False)
+        logger.info(f"Warmed up embedding model in {time.perf_counter() - start:.2f}s")
     
     def add_documents(self, documents: List[Dict[str, Any]]) -> None:
         """Add documents to the vector store"""
@@ -40,7 +282,6 @@ class VectorStore:
             
             # Prepare data for ChromaDB
             ids = []
-            embeddings = []
             metadatas = []
             documents_text = []
             
@@ -52,21 +293,22 @@ class VectorStore:
                 if not content.strip():
                     continue
                 
-                # Generate embedding
-                embedding = self.embedding_model.encode(content).tolist()
-                
                 # Prepare metadata (ChromaDB requires all values to be strings, ints, or floats)
+                # Kept compact since every entry is a SQLite row write during ingest
                 metadata = {
                     'type': str(doc.get('type', 'unknown')),
-                    'title': str(doc.get('title', ''))[:500],  # Limit length
+                    'title': str(doc.get('title', ''))[:200],  # Limit length
                     'url': str(doc.get('url', '')),
-                    'scraped_at': str(doc.get('scraped_at', '')),
                 }
+                scraped_at = _epoch_seconds(doc.get('scraped_at'))
+                if scraped_at is not None:
+                    metadata['scraped_at'] = scraped_at
                 
                 # Add specific fields based on document type
                 if doc.get('type') == 'discourse_post':
                     metadata.update({
                         'author': str(doc.get('author', '')),
+                        'staff': bool(doc.get('staff', False)),
                         'topic_id': str(doc.get('topic_id', '')),
                         'post_number': str(doc.get('post_number', ''))
                     })
@@ -76,7 +318,6 @@ class VectorStore:
                     })
                 
                 ids.append(doc_id)
-                embeddings.append(embedding)
                 metadatas.append(metadata)
                 documents_text.append(content)
             
@@ -84,11 +325,12 @@ class VectorStore:
                 # Add to ChromaDB
                 self.collection.add(
                     ids=ids,
-                    embeddings=embeddings,
+                    embeddings=self._encode_documents(documents_text),
                     metadatas=metadatas,
                     documents=documents_text
                 )
                 
+                self._doc_count += len(ids)
                 logger.info(f"Added {len(ids)} documents to vector store")
             else:
                 logger.warning("No valid documents to add")
@@ -97,15 +339,25 @@ class VectorStore:
             logger.error(f"Error adding documents to vector store: {e}")
             raise
     
-    def search(self, query: str, n_results: int = 5) -> List[Dict[str, Any]]:
+    def _encode_documents(self, texts: List[str]) -> np.ndarray:
+        """Embed documents in one batched call"""
+        return self.embedding_model.encode(
+            texts,
+            batch_size=64,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        ).astype(np.float32, copy=False)
+    
+    def search(self, query: str, n_results: int = 5) -> List[RetrievedDoc]:
         """Search for similar documents"""
         try:
             # Generate query embedding
-            query_embedding = self.embedding_model.encode(query).tolist()
+            query_embedding = self.embed(query)
             
             # Search in ChromaDB
             results = self.collection.query(
-                query_embeddings=[query_embedding],
+                query_embeddings=query_embedding[None, :],
                 n_results=n_results,
                 include=['documents', 'metadatas', 'distances']
             )
@@ -114,12 +366,15 @@ class VectorStore:
             formatted_results = []
             if results['documents'] and results['documents'][0]:
                 for i in range(len(results['documents'][0])):
-                    result = {
-                        'content': results['documents'][0][i],
-                        'metadata': results['metadatas'][0][i],
-                        'distance': results['distances'][0][i] if results['distances'] else None
-                    }
-                    formatted_results.append(result)
+                    metadata = results['metadatas'][0][i] or {}
+                    formatted_results.append(RetrievedDoc(
+                        content=results['documents'][0][i],
+                        url=metadata.get('url', ''),
+                        title=metadata.get('title', ''),
+                        dtype=metadata.get('type', 'unknown'),
+                        distance=results['distances'][0][i] if results['distances'] else None,
+                        staff=bool(metadata.get('staff', False))
+                    ))
             
             logger.info(f"Found {len(formatted_results)} results for query: {query[:100]}...")
             return formatted_results
@@ -128,10 +383,98 @@ class VectorStore:
             logger.error(f"Error searching vector store: {e}")
             return []
     
+    def qa_cache_add(self, question: str, answer: str, links: List[Dict[str, str]],
+                     embedding: Optional[np.ndarray] = None, metadata: Optional[Dict[str, Any]] = None) -> None:
+        """Store an answer in the semantic cache collection"""
+        try:
+            if embedding is None:
+                embedding = self.embed(question)
+            
+            cache_metadata = {
+                'question': question[:500],
+                'response': json.dumps({'answer': answer, 'links': links}),
+                'cached_at': time.time()
+            }
+            cache_metadata.update(metadata or {})
+            
+            # Time-ordered ids, so eviction can find the oldest entries without reading metadata
+            self.qa_cache.add(
+                ids=[f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"],
+                embeddings=np.asarray(embedding, dtype=np.float32)[None, :],
+                metadatas=[cache_metadata],
+                documents=[question]
+            )
+            self._qa_cache_evict()
+        except Exception as e:
+            logger.error(f"Error adding to QA cache: {e}")
+    
+    def _qa_cache_evict(self) -> None:
+        """Purge expired cache entries when due, then the oldest ones beyond qa_cache_max_entries"""
+        now = time.time()
+        if now - self._qa_cache_purged_at >= self.qa_cache_purge_interval:
+            self._qa_cache_purged_at = now
+            self.qa_cache.delete(where={"cached_at": {"$lt": now - self.qa_cache_ttl}})
+        
+        excess = self.qa_cache.count() - self.qa_cache_max_entries
+        if excess > 0:
+            # Trim an extra tenth so a full cache isn't re-sorted on every add
+            oldest = sorted(self.qa_cache.get(include=[])['ids'])[:excess + self.qa_cache_max_entries // 10]
+            self.qa_cache.delete(ids=oldest)
+            logger.info(f"Evicted {len(oldest)} QA cache entries")
+    
+    def qa_cache_lookup(self, question: str, threshold: float = 0.92, embedding: Optional[np.ndarray] = None,
+                        where: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """Return the cached answer for the nearest cached question if its cosine similarity meets the threshold"""
+        try:
+            if embedding is None:
+                embedding = self.embed(question)
+            
+            # Expired entries are filtered out here, so one can't hide a valid entry behind it
+            fresh = {"cached_at": {"$gte": time.time() - self.qa_cache_ttl}}
+            results = self.qa_cache.query(
+                query_embeddings=np.asarray(embedding, dtype=np.float32)[None, :],
+                n_results=1,
+                where={"$and": [where, fresh]} if where else fresh,
+                include=['metadatas', 'distances']
+            )
+            if not results['ids'] or not results['ids'][0]:
+                return None
+            
+            # Cosine space: distance = 1 - similarity
+            score = 1 - results['distances'][0][0]
+            metadata = results['metadatas'][0][0]
+            if score < threshold:
+                return None
+            
+            return json.loads(metadata['response'])
+            
+        except Exception as e:
+            logger.error(f"Error looking up QA cache: {e}")
+            return None
+    
+    def qa_cache_clear(self) -> None:
+        """Remove every entry from the semantic cache collection"""
+        try:
+            while True:
+                ids = self.qa_cache.get(limit=5000, include=[])['ids']
+                if not ids:
+                    break
+                self.qa_cache.delete(ids=ids)
+        except Exception as e:
+            logger.error(f"Error clearing QA cache: {e}")
+    
+    def count(self) -> int:
+        """Number of documents in the collection, refreshed lazily from ChromaDB"""
+        now = time.monotonic()
+        if now - self._doc_count_at >= self.count_refresh_interval:
+            self._doc_count = self.collection.count()
+            self._doc_count_at = now
+        return self._doc_count
+    
     def get_collection_info(self) -> Dict[str, Any]:
         """Get information about the collection"""
         try:
-            count = self.collection.count()
+            count = self.count()
             return {
                 'total_documents': count,
                 'collection_name': self.collection.name,
@@ -144,16 +487,23 @@ class VectorStore:
     def clear_collection(self) -> None:
         """Clear all documents from the collection"""
         try:
-            # Delete the collection and recreate it
-            self.client.delete_collection(name="tds_knowledge_base")
-            self.collection = self.client.get_or_create_collection(
-                name="tds_knowledge_base",
-                metadata={"description": "TDS course content and discourse posts"}
-            )
+            if self.index_outdated:
+                # Nothing to keep, so recreate it with the current index settings
+                with self._rebuild_lock():
+                    self.client.delete_collection(COLLECTION_NAME)
+                    self.collection = self.client.create_collection(name=COLLECTION_NAME, metadata=COLLECTION_METADATA)
+            else:
+                # Delete by id in batches rather than dropping the collection, so the handle stays
+                # valid for searches already in flight (they just see fewer documents)
+                while True:
+                    ids = self.collection.get(limit=5000, include=[])['ids']
+                    if not ids:
+                        break
+                    self.collection.delete(ids=ids)
+            self._doc_count = 0
+            self._doc_count_at = time.monotonic()
             logger.info("Cleared vector store collection")
         except Exception as e:
             logger.error(f"Error clearing collection: {e}")
             raise
 
-# Global instance
-vector_store = VectorStore()
@@ -1,8 +1,12 @@
 import json
 import base64
-import subprocess
 import sys
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import requests
+from requests.adapters import HTTPAdapter
 
 class TDSVirtualAssistantAPITester:
     def __init__(self, base_url="https://0611d488-7360-4f0e-9013-4cdc03adf146.preview.emergentagent.com"):
@@ -11,42 +15,45 @@ class TDSVirtualAssistantAPITester:
         self.tests_run = 0
         self.tests_passed = 0
         self.test_results = []
+        # Tests run concurrently from main(), so shared counters and results are updated under this lock
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger('tester')
+        
+        # One keep-alive session for the whole suite so TCP/TLS setup happens once per connection
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     def run_test(self, name, method, endpoint, expected_status, data=None, validate_func=None):
-        """Run a single API test using curl"""
+        """Run a single API test over the shared HTTP session"""
         url = f"{self.api_url}/{endpoint}".rstrip('/')
         
-        self.tests_run += 1
-        print(f"\n🔍 Testing {name}...")
+        with self._lock:
+            self.tests_run += 1
+        self.logger.info(f"🔍 Testing {name}...")
         
         try:
-            # Build curl command
-            if method == 'GET':
-                cmd = ['curl', '-s', '-w', '%{http_code}', url]
-            elif method == 'POST':
-                cmd = ['curl', '-s', '-w', '%{http_code}', '-X', 'POST', 
-                       '-H', 'Content-Type: application/json', 
-                       '-d', json.dumps(data), 
-                       url]
-            else:
+            if method not in ('GET', 'POST'):
                 raise ValueError(f"Unsupported method: {method}")
             
-            # Execute curl command
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            
-            # Extract status code from the last line
-            output = result.stdout
-            status_code = int(output[-3:])  # Last 3 characters should be status code
-            response_body = output[:-3]  # Everything except the last 3 characters
+            # Pre-serialized bodies are sent as-is; dicts are encoded by requests
+            if isinstance(data, bytes):
+                response = self.session.request(
+                    method, url, data=data, headers={"Content-Type": "application/json"}, timeout=30
+                )
+            else:
+                response = self.session.request(method, url, json=data, timeout=30)
+            status_code = response.status_code
             
             status_success = status_code == expected_status
             
             # Try to parse JSON response
             try:
-                response_data = json.loads(response_body)
+                response_data = response.json()
                 json_success = True
-            except json.JSONDecodeError:
-                response_data = response_body
+            except ValueError:
+                response_data = response.text
                 json_success = False
             
             # Run custom validation if provided
@@ -58,34 +65,38 @@ class TDSVirtualAssistantAPITester:
             success = status_success and (validate_func is None or validation_success)
             
             if success:
-                self.tests_passed += 1
-                print(f"✅ Passed - Status: {status_code}")
+                with self._lock:
+                    self.tests_passed += 1
+                # Tests run concurrently, so each result line names its test
+                self.logger.info(f"✅ {name} passed - Status: {status_code}")
                 if validation_message:
-                    print(f"   {validation_message}")
+                    self.logger.info(f"   {validation_message}")
             else:
-                print(f"❌ Failed - Expected status {expected_status}, got {status_code}")
+                self.logger.info(f"❌ {name} failed - Expected status {expected_status}, got {status_code}")
                 if not validation_success:
-                    print(f"   Validation failed: {validation_message}")
+                    self.logger.info(f"   Validation failed: {validation_message}")
             
             # Store test result
-            self.test_results.append({
-                "name": name,
-                "success": success,
-                "status_code": status_code,
-                "expected_status": expected_status,
-                "response": response_data,
-                "validation_message": validation_message if not validation_success else ""
-            })
+            with self._lock:
+                self.test_results.append({
+                    "name": name,
+                    "success": success,
+                    "status_code": status_code,
+                    "expected_status": expected_status,
+                    "response": response_data,
+                    "validation_message": validation_message if not validation_success else ""
+                })
             
             return success, response_data
 
         except Exception as e:
-            print(f"❌ Failed - Error: {str(e)}")
-            self.test_results.append({
-                "name": name,
-                "success": False,
-                "error": str(e)
-            })
+            self.logger.info(f"❌ {name} failed - Error: {str(e)}")
+            with self._lock:
+                self.test_results.append({
+                    "name": name,
+                    "success": False,
+                    "error": str(e)
+                })
             return False, {"error": str(e)}
 
     def test_root_endpoint(self):
@@ -114,14 +125,14 @@ class TDSVirtualAssistantAPITester:
             )
         )
 
-    def test_question_endpoint(self, question):
-        """Test the question answering endpoint"""
+    def test_question_endpoint(self, question, payload=None):
+        """Test the question answering endpoint, optionally with the request body already encoded"""
         return self.run_test(
             f"Question Endpoint - '{question[:30]}...' if len(question) > 30 else question",
             "POST",
             "",
             200,
-            data={"question": question},
+            data=payload if payload is not None else {"question": question},
             validate_func=lambda data: (
                 "answer" in data and "links" in data and isinstance(data["links"], list),
                 f"Response contains answer and links: answer length={len(data.get('answer', ''))}, links count={len(data.get('links', []))}"
@@ -137,7 +148,7 @@ class TDSVirtualAssistantAPITester:
                 with open(image_path, "rb") as image_file:
                     image_base64 = base64.b64encode(image_file.read()).decode('utf-8')
             except Exception as e:
-                print(f"Warning: Could not read image file: {e}")
+                self.logger.warning(f"Warning: Could not read image file: {e}")
         
         return self.run_test(
             f"Question with Image - '{question[:30]}...' if len(question) > 30 else question",
@@ -162,37 +173,34 @@ class TDSVirtualAssistantAPITester:
         )
 
     def print_summary(self):
-        """Print a summary of all test results"""
-        print("\n" + "="*50)
-        print(f"📊 TEST SUMMARY: {self.tests_passed}/{self.tests_run} tests passed")
-        print("="*50)
+        """Log a summary of all test results"""
+        self.logger.info("\n" + "="*50)
+        self.logger.info(f"📊 TEST SUMMARY: {self.tests_passed}/{self.tests_run} tests passed")
+        self.logger.info("="*50)
         
-        # Print failed tests
+        # Log failed tests
         if self.tests_passed < self.tests_run:
-            print("\nFailed Tests:")
+            self.logger.info("\nFailed Tests:")
             for result in self.test_results:
                 if not result.get("success", False):
-                    print(f"- {result['name']}")
+                    self.logger.info(f"- {result['name']}")
                     if "error" in result:
-                        print(f"  Error: {result['error']}")
+                        self.logger.info(f"  Error: {result['error']}")
                     elif "validation_message" in result and result["validation_message"]:
-                        print(f"  Reason: {result['validation_message']}")
+                        self.logger.info(f"  Reason: {result['validation_message']}")
                     else:
-                        print(f"  Status: Got {result.get('status_code')}, expected {result.get('expected_status')}")
+                        self.logger.info(f"  Status: Got {result.get('status_code')}, expected {result.get('expected_status')}")
         
         return self.tests_passed == self.tests_run
 
 def main():
-    # Setup
+    # Setup; each log record is written whole, so concurrent tests don't interleave mid-line
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     tester = TDSVirtualAssistantAPITester()
     
     # Run tests
-    print("Starting TDS Virtual Teaching Assistant API Tests")
-    print("="*50)
-    
-    # Test basic endpoints
-    tester.test_root_endpoint()
-    tester.test_status_endpoint()
+    tester.logger.info("Starting TDS Virtual Teaching Assistant API Tests")
+    tester.logger.info("="*50)
     
     # Test with sample questions from the frontend
     sample_questions = [
@@ -201,15 +209,22 @@ def main():
         "How do I handle machine learning models in assignments?",
         "What are the key topics in Tools in Data Science?"
     ]
+    # Encode each request body once up front
+    question_payloads = [(q, json.dumps({"question": q}).encode()) for q in sample_questions]
     
-    for question in sample_questions:
-        tester.test_question_endpoint(question)
-    
-    # Test with an invalid request
-    tester.test_invalid_request()
-    
-    # Test with a question containing special characters
-    tester.test_question_endpoint("What's the difference between t-SNE and PCA? Can you explain in <10 lines?")
+    # The tests are independent and mostly waiting on the LLM, so run them concurrently;
+    # total time is roughly that of the slowest test rather than the sum
+    tasks = [
+        tester.test_root_endpoint,
+        tester.test_status_endpoint,
+        *[lambda q=question, body=payload: tester.test_question_endpoint(q, body) for question, payload in question_payloads],
+        # Test with an invalid request
+        tester.test_invalid_request,
+        # Test with a question containing special characters
+        lambda: tester.test_question_endpoint("What's the difference between t-SNE and PCA? Can you explain in <10 lines?"),
+    ]
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        list(executor.map(lambda test: test(), tasks))
     
     # Print summary
     success = tester.print_summary()
@@ -6,12 +6,17 @@ Discourse Scraping Script for TDS Course
 This script scrapes Discourse posts from the TDS course forum for a specified date range.
 It's designed to work with the IIT Madras Online Degree program's Discourse instance.
 
-Usage:
-    python scrape_discourse.py --start-date 2025-01-01 --end-date 2025-04-14 --category tds-kb
+Usage (from the repository root, so the backend package is importable):
+    python -m scripts.scrape_discourse --start-date 2025-01-01 --end-date 2025-04-14 --category tds-kb
 
 Requirements:
     - requests
-    - beautifulsoup4
+    - aiohttp
+    - requests-cache, aiohttp-client-cache (optional, for the on-disk response cache)
+    - httpx[http2] (optional, for --http2)
+    - selectolax
+    - orjson
+    - ciso8601 (optional, faster date parsing)
     - python-dotenv
 
 Author: TDS Virtual Teaching Assistant Project
@@ -19,16 +24,24 @@ License: MIT
 """
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import asyncio
+import orjson
 import argparse
-from datetime import datetime, timedelta
+import re
+import zlib
+import base64
+from datetime import datetime, timedelta, timezone
 from urllib.parse import urljoin
-import time
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Iterable, Iterator, Tuple
 import os
 from pathlib import Path
 
+from backend.http_retry import RETRY_STATUSES, retry_delay
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -36,21 +49,141 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+_WS_RE = re.compile(r'\s+')
+
+# C ISO-8601 parser when available; Discourse timestamps look like 2025-01-15T10:30:00.000Z
+try:
+    import ciso8601
+    _parse_iso = ciso8601.parse_datetime
+except ImportError:
+    def _parse_iso(value: str) -> datetime:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def _parse_timestamp(value: str) -> datetime:
+    """Parse an ISO-8601 timestamp as an aware datetime, treating naive values as UTC"""
+    parsed = _parse_iso(value)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def _created_within(topic: Dict[str, Any], start_dt: datetime, end_dt: datetime) -> bool:
+    """Whether a listed topic was created within [start_dt, end_dt]; unparseable dates are excluded"""
+    created_at_str = topic.get('created_at')
+    if not created_at_str:
+        return False
+    try:
+        return start_dt <= _parse_timestamp(created_at_str) <= end_dt
+    except ValueError as e:
+        logger.warning("Could not parse date %s: %s", created_at_str, e)
+        return False
+
 class DiscourseScraper:
     """Scraper for Discourse forum posts"""
     
-    def __init__(self, base_url: str = "https://discourse.onlinedegree.iitm.ac.in"):
+    def __init__(self, base_url: str = "https://discourse.onlinedegree.iitm.ac.in", use_cache: bool = True,
+                 cache_name: str = "discourse_cache", cache_expire_after: int = 3600, keep_raw: bool = False,
+                 http2: bool = False):
         """
         Initialize the scraper
         
         Args:
             base_url: Base URL of the Discourse instance
+            use_cache: Cache successful responses in SQLite so re-runs over the same range skip the network
+            cache_name: Base name of the SQLite cache files
+            cache_expire_after: Seconds before a cached response is revalidated (via ETag when available)
+            keep_raw: Also store each post's raw markdown, zlib-compressed and base64-encoded
+            http2: Fetch topics with httpx over HTTP/2, multiplexing requests on a few connections
+                   (bypasses the on-disk cache)
         """
         self.base_url = base_url
-        self.session = requests.Session()
+        self.keep_raw = keep_raw
+        self.http2 = http2 and self._http2_available()
+        self.cache_name = cache_name
+        self.cache_expire_after = cache_expire_after
+        self.use_cache = use_cache and self._cache_available()
+        
+        # Parsed posts per topic id, so scrape_topic only fetches a topic once per scraper; the
+        # streaming path doesn't use it, since it would end up holding the whole scrape
+        self._topic_cache: Dict[int, List[Dict[str, Any]]] = {}
+        
+        # Network failures _fetch_json retries, for whichever async client is in use
+        self._transient_errors: Tuple[type, ...] = (
+            aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError
+        )
+        if self.http2:
+            import httpx
+            self._transient_errors += (httpx.TransportError,)
+        
+        if self.use_cache:
+            import requests_cache
+            self.session = requests_cache.CachedSession(
+                cache_name,
+                backend='sqlite',
+                expire_after=cache_expire_after,
+                allowable_codes=(200,)
+            )
+        else:
+            self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
+        
+        # Keep warm connections to the forum and retry transient failures with backoff
+        retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+    
+    @staticmethod
+    def _cache_available() -> bool:
+        """Whether the optional cache packages are installed"""
+        try:
+            import requests_cache  # noqa: F401
+            import aiohttp_client_cache  # noqa: F401
+            return True
+        except ImportError:
+            logger.warning("requests-cache/aiohttp-client-cache not installed, scraping without a response cache")
+            return False
+    
+    @staticmethod
+    def _http2_available() -> bool:
+        """Whether httpx with HTTP/2 support is installed"""
+        try:
+            import httpx  # noqa: F401
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            logger.warning("httpx[http2] not installed, fetching over HTTP/1.1 with aiohttp")
+            return False
+    
+    def _client_session(self) -> Any:
+        """
+        Create the async HTTP client for a scrape
+        
+        An httpx HTTP/2 client when http2 is enabled, otherwise an aiohttp session backed by
+        the on-disk cache when that is enabled
+        """
+        if self.http2:
+            import httpx
+            # Only the User-Agent: HTTP/2 forbids connection-specific headers such as the
+            # Connection: keep-alive that requests adds to its session defaults
+            return httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=20),
+                headers={'User-Agent': self.session.headers['User-Agent']},
+                timeout=30
+            )
+        
+        connector = aiohttp.TCPConnector(limit=20, keepalive_timeout=30)
+        if not self.use_cache:
+            return aiohttp.ClientSession(connector=connector, headers=self.session.headers)
+        
+        from aiohttp_client_cache import CachedSession, SQLiteBackend
+        # Separate file from the requests-cache one; the two libraries use different schemas
+        cache = SQLiteBackend(
+            f"{self.cache_name}_async",
+            expire_after=self.cache_expire_after,
+            allowed_codes=(200,)
+        )
+        return CachedSession(cache=cache, connector=connector, headers=self.session.headers)
     
     def scrape_category(self, category_id: str, start_date: str, end_date: str) -> List[Dict[str, Any]]:
         """
@@ -64,71 +197,157 @@ class DiscourseScraper:
         Returns:
             List of post dictionaries
         """
-        posts = []
-        start_dt = datetime.strptime(start_date, '%Y-%m-%d')
-        end_dt = datetime.strptime(end_date, '%Y-%m-%d')
+        return list(self.iter_category(category_id, start_date, end_date))
+    
+    def iter_category(self, category_id: str, start_date: str, end_date: str) -> Iterator[Dict[str, Any]]:
+        """
+        Yield posts from a specific category within a date range as their topics finish downloading
         
+        Synchronous view of iter_category_async, so callers can write posts out as they arrive
+        instead of holding the whole scrape in memory.
+        """
+        loop = asyncio.new_event_loop()
+        posts = self.iter_category_async(category_id, start_date, end_date)
         try:
-            # Get category URL - try both slug and ID
-            if category_id.isdigit():
-                category_url = f"{self.base_url}/c/{category_id}.json"
-            else:
-                category_url = f"{self.base_url}/c/{category_id}.json"
-                
-            logger.info(f"Fetching category data from: {category_url}")
-            
-            response = self.session.get(category_url)
-            response.raise_for_status()
-            
-            category_data = response.json()
-            
-            if 'topic_list' not in category_data or 'topics' not in category_data['topic_list']:
-                logger.warning("No topics found in category response")
-                return posts
+            while True:
+                try:
+                    yield loop.run_until_complete(posts.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(posts.aclose())
+            loop.close()
+    
+    async def scrape_category_async(self, category_id: str, start_date: str, end_date: str) -> List[Dict[str, Any]]:
+        """
+        Scrape posts from a specific category within a date range, fetching topics concurrently
+        
+        Args:
+            category_id: Category identifier (e.g., 'tds-kb' or '34')
+            start_date: Start date in YYYY-MM-DD format
+            end_date: End date in YYYY-MM-DD format
             
-            topics = category_data['topic_list']['topics']
-            logger.info(f"Found {len(topics)} topics in category")
+        Returns:
+            List of post dictionaries
+        """
+        return [post async for post in self.iter_category_async(category_id, start_date, end_date)]
+    
+    async def iter_category_async(self, category_id: str, start_date: str,
+                                  end_date: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yield posts from a specific category within a date range, fetching topics concurrently
+        
+        Args:
+            category_id: Category identifier (e.g., 'tds-kb' or '34')
+            start_date: Start date in YYYY-MM-DD format
+            end_date: End date in YYYY-MM-DD format
             
-            for topic in topics:
+        Yields:
+            Post dictionaries, one topic's posts at a time in completion order
+        """
+        # Aware bounds so topic timestamps compare without stripping their timezone
+        start_dt = datetime.strptime(start_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+        end_dt = datetime.strptime(end_date, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+        total = 0
+        
+        try:
+            async with self._client_session() as session:
+                # Get topic details concurrently, at most 8 requests in flight (32 when they are
+                # multiplexed over HTTP/2 rather than each needing a pooled connection). Topics are
+                # scheduled as the listing pages arrive, with at most twice that many queued, and
+                # each task is dropped once its posts are yielded
+                limit = 32 if self.http2 else 8
+                semaphore = asyncio.Semaphore(limit)
+                pending = set()
+                listed = 0
+                topics = self._iter_pages(session, category_id, start_dt)
                 try:
-                    # Check if topic is within date range
-                    created_at_str = topic.get('created_at', '')
-                    if not created_at_str:
-                        continue
-                        
-                    # Parse date (handle different formats)
-                    try:
-                        if 'T' in created_at_str:
-                            created_at = datetime.fromisoformat(created_at_str.replace('Z', '+00:00'))
-                        else:
-                            created_at = datetime.strptime(created_at_str, '%Y-%m-%d')
-                    except ValueError as e:
-                        logger.warning(f"Could not parse date {created_at_str}: {e}")
-                        continue
-                    
-                    # Remove timezone info for comparison
-                    created_at = created_at.replace(tzinfo=None)
+                    async for topic in topics:
+                        listed += 1
+                        # Date-filter the listing so only in-range topics cost a request
+                        if not _created_within(topic, start_dt, end_dt):
+                            continue
+                        pending.add(asyncio.ensure_future(self.scrape_topic_async(session, semaphore, topic['id'])))
+                        if len(pending) >= 2 * limit:
+                            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                            for task in done:
+                                for post in task.result():
+                                    total += 1
+                                    yield post
                     
-                    if not (start_dt <= created_at <= end_dt):
+                    while pending:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            for post in task.result():
+                                total += 1
+                                yield post
+                finally:
+                    await topics.aclose()
+                    for task in pending:
+                        task.cancel()
+                
+                if not listed:
+                    logger.warning("No topics found in category response")
+                    return
+                
+                logger.info("Successfully scraped %s posts from %s listed topics in date range %s to %s",
+                            total, listed, start_date, end_date)
+        
+        except Exception as e:
+            logger.error("Error scraping category %s: %s", category_id, e)
+    
+    async def _iter_pages(self, session: aiohttp.ClientSession, category_id: str,
+                          start_dt: datetime, batch_size: int = 4) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yield the category's topics page by page, newest created first
+        
+        Pages are requested batch_size at a time. Paging stops at an empty page, a page with
+        no unseen topics, or once a page reaches topics created before start_dt (pinned
+        topics don't count, since they stay at the top regardless of age). A page that still
+        fails after retries also ends paging, keeping the topics listed before it.
+        """
+        category_url = f"{self.base_url}/c/{category_id}.json"
+        logger.info("Fetching category data from: %s", category_url)
+        
+        seen_ids = set()
+        page = 0
+        while True:
+            pages = await asyncio.gather(*[
+                self._fetch_json(session, f"{category_url}?order=created&page={n}")
+                for n in range(page, page + batch_size)
+            ], return_exceptions=True)
+            
+            for n, category_data in enumerate(pages, start=page):
+                if isinstance(category_data, BaseException):
+                    logger.error("Error fetching page %s of category %s, stopping there: %s",
+                                 n, category_id, category_data)
+                    return
+                
+                topics = category_data.get('topic_list', {}).get('topics', [])
+                if not topics:
+                    return
+                
+                oldest = None
+                new_topics = 0
+                for topic in topics:
+                    if topic.get('id') in seen_ids:
                         continue
+                    seen_ids.add(topic.get('id'))
+                    new_topics += 1
+                    yield topic
                     
-                    # Get topic details
-                    topic_posts = self.scrape_topic(topic['id'])
-                    posts.extend(topic_posts)
-                    
-                    # Be respectful - add small delay
-                    time.sleep(0.5)
-                    
-                except Exception as e:
-                    logger.warning(f"Error processing topic {topic.get('id', 'unknown')}: {e}")
-                    continue
-            
-            logger.info(f"Successfully scraped {len(posts)} posts from date range {start_date} to {end_date}")
-            return posts
+                    if topic.get('created_at') and not topic.get('pinned'):
+                        try:
+                            created_at = _parse_timestamp(topic['created_at'])
+                        except ValueError:
+                            continue
+                        oldest = created_at if oldest is None else min(oldest, created_at)
+                
+                # A page of only repeats means the server ignored the page number
+                if not new_topics or (oldest is not None and oldest < start_dt):
+                    return
             
-        except Exception as e:
-            logger.error(f"Error scraping category {category_id}: {e}")
-            return posts
+            page += batch_size
     
     def scrape_topic(self, topic_id: int) -> List[Dict[str, Any]]:
         """
@@ -140,44 +359,122 @@ class DiscourseScraper:
         Returns:
             List of post dictionaries
         """
-        posts = []
+        if topic_id in self._topic_cache:
+            return self._topic_cache[topic_id]
         
         try:
             topic_url = f"{self.base_url}/t/{topic_id}.json"
             response = self.session.get(topic_url)
             response.raise_for_status()
             
-            topic_data = response.json()
-            
-            if 'post_stream' not in topic_data or 'posts' not in topic_data['post_stream']:
-                return posts
+            posts = self._parse_topic(topic_id, orjson.loads(response.content))
+            self._topic_cache[topic_id] = posts
+            return posts
             
-            topic_title = topic_data.get('title', 'Unknown Topic')
-            topic_slug = topic_data.get('slug', str(topic_id))
+        except Exception as e:
+            logger.error("Error scraping topic %s: %s", topic_id, e)
+            return []
+    
+    async def scrape_topic_async(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore,
+                                 topic_id: int) -> List[Dict[str, Any]]:
+        """
+        Scrape all posts from a specific topic over an aiohttp session
+        
+        Args:
+            session: Shared aiohttp session
+            semaphore: Bounds the number of concurrent topic requests
+            topic_id: Topic ID
             
-            for post in topic_data['post_stream']['posts']:
-                post_content = self._clean_content(post.get('cooked', ''))
-                
-                if post_content and len(post_content.strip()) > 10:
-                    posts.append({
-                        'id': f"discourse_post_{post['id']}",
-                        'type': 'discourse_post',
-                        'title': topic_title,
-                        'content': post_content,
-                        'raw_content': post.get('raw', ''),
-                        'url': f"{self.base_url}/t/{topic_slug}/{topic_id}/{post.get('post_number', 1)}",
-                        'author': post.get('username', ''),
-                        'created_at': post.get('created_at', ''),
-                        'topic_id': topic_id,
-                        'post_number': post.get('post_number', 1),
-                        'scraped_at': datetime.utcnow().isoformat()
-                    })
+        Returns:
+            List of post dictionaries
+        """
+        try:
+            async with semaphore:
+                topic_data = await self._fetch_json(session, f"{self.base_url}/t/{topic_id}.json")
+                # Be respectful - short pause before releasing the slot
+                await asyncio.sleep(0.05)
             
-            return posts
+            return self._parse_topic(topic_id, topic_data)
             
         except Exception as e:
-            logger.error(f"Error scraping topic {topic_id}: {e}")
+            logger.error("Error scraping topic %s: %s", topic_id, e)
+            return []
+    
+    async def _fetch_json(self, session: aiohttp.ClientSession, url: str, max_attempts: int = 4) -> Dict[str, Any]:
+        """
+        Fetch a URL and decode its JSON body with orjson
+        
+        Rate-limited (429) and 5xx responses and dropped connections are retried up to
+        max_attempts times, waiting as long as the server's Retry-After asks when it sends one.
+        """
+        for attempt in range(1, max_attempts + 1):
+            try:
+                status, headers, body = await self._get(session, url, final=attempt == max_attempts)
+            except self._transient_errors as e:
+                # A bad certificate won't fix itself between attempts
+                if attempt == max_attempts or isinstance(e, aiohttp.ClientSSLError):
+                    raise
+                delay, reason = retry_delay(None, attempt), type(e).__name__
+            else:
+                if status < 400:
+                    return orjson.loads(body)
+                delay, reason = retry_delay(headers.get('Retry-After'), attempt), f"HTTP {status}"
+            
+            logger.warning("%s from %s, retrying in %.1fs (attempt %s/%s)", reason, url, delay, attempt, max_attempts)
+            await asyncio.sleep(delay)
+    
+    async def _get(self, session: aiohttp.ClientSession, url: str, final: bool) -> Tuple[int, Any, bytes]:
+        """
+        GET a URL, returning its status, headers and body
+        
+        Error statuses raise unless they are retryable and this isn't the final attempt.
+        """
+        if self.http2:
+            response = await session.get(url)
+            if final or response.status_code not in RETRY_STATUSES:
+                response.raise_for_status()
+            return response.status_code, response.headers, response.content
+        
+        async with session.get(url) as response:
+            if final or response.status not in RETRY_STATUSES:
+                response.raise_for_status()
+            return response.status, response.headers, await response.read()
+    
+    def _parse_topic(self, topic_id: int, topic_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Build post dictionaries from a topic's JSON"""
+        posts = []
+        
+        topic_posts = (topic_data.get('post_stream') or {}).get('posts')
+        if not topic_posts:
             return posts
+        
+        topic_title = topic_data.get('title', 'Unknown Topic')
+        topic_slug = topic_data.get('slug', str(topic_id))
+        scraped_at = datetime.utcnow().isoformat()
+        
+        for post in topic_posts:
+            post_content = self._clean_content(post.get('cooked', ''))
+            
+            if post_content and len(post_content.strip()) > 10:
+                posts.append({
+                    'id': f"discourse_post_{post['id']}",
+                    'type': 'discourse_post',
+                    'title': topic_title,
+                    'content': post_content,
+                    'url': f"{self.base_url}/t/{topic_slug}/{topic_id}/{post.get('post_number', 1)}",
+                    'author': post.get('username', ''),
+                    'staff': bool(post.get('staff')),
+                    'created_at': post.get('created_at', ''),
+                    'topic_id': topic_id,
+                    'post_number': post.get('post_number', 1),
+                    'scraped_at': scraped_at
+                })
+                # Nothing downstream reads the raw markdown, so it's opt-in and compressed
+                if self.keep_raw:
+                    raw = zlib.compress(post.get('raw', '').encode('utf-8'), 1)
+                    posts[-1]['raw_content'] = base64.b64encode(raw).decode('ascii')
+        
+        return posts
     
     def _clean_content(self, html_content: str) -> str:
         """Clean HTML content and extract text"""
@@ -185,34 +482,46 @@ class DiscourseScraper:
             return ""
         
         try:
-            from bs4 import BeautifulSoup
-            soup = BeautifulSoup(html_content, 'html.parser')
+            from selectolax.parser import HTMLParser
+            tree = HTMLParser(html_content)
             
             # Remove script and style elements
-            for script in soup(["script", "style"]):
-                script.decompose()
+            for node in tree.css('script, style'):
+                node.decompose()
             
             # Get text content
-            text = soup.get_text()
+            text = tree.text(separator=' ', strip=True)
             
             # Clean up whitespace
-            lines = (line.strip() for line in text.splitlines())
-            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-            text = ' '.join(chunk for chunk in chunks if chunk)
-            
-            return text
+            return _WS_RE.sub(' ', text).strip()
         except Exception as e:
-            logger.warning(f"Error cleaning content: {e}")
+            logger.warning("Error cleaning content: %s", e)
             return html_content
     
-    def save_to_file(self, posts: List[Dict[str, Any]], output_file: str):
-        """Save posts to JSON file"""
+    def save_to_file(self, posts: Iterable[Dict[str, Any]], output_file: str) -> int:
+        """
+        Save posts to a file, returning how many were written
+        
+        .jsonl files are written one post per line as posts arrive, so a streamed scrape never
+        holds every post in memory; any other extension gets a single indented JSON array.
+        """
+        count = 0
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(posts, f, indent=2, ensure_ascii=False)
-            logger.info(f"Saved {len(posts)} posts to {output_file}")
+            with open(output_file, 'wb') as f:
+                if output_file.endswith('.jsonl'):
+                    for post in posts:
+                        f.write(orjson.dumps(post))
+                        f.write(b'\n')
+                        count += 1
+                else:
+                    # orjson writes UTF-8 bytes directly (no ASCII escaping), matching ensure_ascii=False
+                    posts = list(posts)
+                    count = len(posts)
+                    f.write(orjson.dumps(posts, option=orjson.OPT_INDENT_2))
+            logger.info("Saved %s posts to %s", count, output_file)
         except Exception as e:
-            logger.error(f"Error saving to file {output_file}: {e}")
+            logger.error("Error saving to file %s: %s", output_file, e)
+        return count
 
 def main():
     """Main function to run the scraper"""
@@ -220,8 +529,11 @@ def main():
     parser.add_argument('--start-date', default='2025-01-01', help='Start date (YYYY-MM-DD)')
     parser.add_argument('--end-date', default='2025-04-14', help='End date (YYYY-MM-DD)')
     parser.add_argument('--category', default='tds-kb/34', help='Category slug or ID (e.g., tds-kb or 34)')
-    parser.add_argument('--output', default='discourse_posts.json', help='Output JSON file')
+    parser.add_argument('--output', default='discourse_posts.jsonl', help='Output file (.jsonl streams one post per line, otherwise a JSON array)')
     parser.add_argument('--base-url', default='https://discourse.onlinedegree.iitm.ac.in', help='Discourse base URL')
+    parser.add_argument('--keep-raw', action='store_true', help='Store each post\'s raw markdown (zlib + base64) alongside the cleaned text')
+    parser.add_argument('--http2', action='store_true', help='Fetch topics over HTTP/2 with httpx (skips the on-disk cache)')
+    parser.add_argument('--disable-cache', action='store_true', help='Always fetch from the network instead of the on-disk cache')
     
     args = parser.parse_args()
     
@@ -234,7 +546,12 @@ def main():
         return 1
     
     # Initialize scraper
-    scraper = DiscourseScraper(args.base_url)
+    scraper = DiscourseScraper(
+        args.base_url,
+        use_cache=not args.disable_cache,
+        keep_raw=args.keep_raw,
+        http2=args.http2
+    )
     
     # Handle category format (e.g., "tds-kb/34" or just "34")
     if '/' in args.category:
@@ -243,26 +560,34 @@ def main():
     else:
         category_id = args.category
     
-    logger.info(f"Starting scrape for category {category_id} from {args.start_date} to {args.end_date}")
+    logger.info("Starting scrape for category %s from %s to %s", category_id, args.start_date, args.end_date)
     
-    # Scrape posts
-    posts = scraper.scrape_category(category_id, args.start_date, args.end_date)
+    # Scrape posts straight into the output file, keeping only the first one for the summary
+    first_posts = []
     
-    if posts:
-        # Save to file
-        scraper.save_to_file(posts, args.output)
-        
+    def keep_first(posts: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        for post in posts:
+            if not first_posts:
+                first_posts.append(post)
+            yield post
+    
+    total = scraper.save_to_file(
+        keep_first(scraper.iter_category(category_id, args.start_date, args.end_date)),
+        args.output
+    )
+    
+    if total:
         # Print summary
         print(f"\nScraping Summary:")
         print(f"Category: {args.category}")
         print(f"Date range: {args.start_date} to {args.end_date}")
-        print(f"Total posts scraped: {len(posts)}")
+        print(f"Total posts scraped: {total}")
         print(f"Output file: {args.output}")
         
         # Show sample post
-        if posts:
+        if first_posts:
             print(f"\nSample post:")
-            sample = posts[0]
+            sample = first_posts[0]
             print(f"Title: {sample.get('title', 'N/A')}")
             print(f"Author: {sample.get('author', 'N/A')}")
             print(f"URL: {sample.get('url', 'N/A')}")
@@ -0,0 +1,63 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import BadRequestError, InternalServerError, RateLimitError
+
+from backend import async_llm
+
+def _error(cls, status: int):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    return cls(f"HTTP {status}", response=httpx.Response(status, request=request), body=None)
+
+class StubClient:
+    """Chat client that answers prompts out of order and raises queued errors first"""
+    
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.calls = []
+        self.chat = SimpleNamespace(completions=self)
+    
+    async def create(self, model, messages, **kwargs):
+        question = messages[-1]["content"]
+        self.calls.append(question)
+        if self.errors.get(question):
+            raise self.errors[question].pop(0)
+        
+        # Later prompts finish first, so results only line up if run_batch reorders them
+        await asyncio.sleep(0.01 * (10 - int(question[1:])))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f" answer {question} "))])
+
+def _run(client, count=5, **kwargs):
+    prompts = [[{"role": "user", "content": f"q{i}"}] for i in range(count)]
+    return asyncio.run(async_llm.run_batch(prompts, rpm=600, tpm=100000, client=client, **kwargs))
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(async_llm, "MAX_RETRY_DELAY", 0)
+
+def test_results_follow_prompt_order():
+    assert _run(StubClient()) == [f"answer q{i}" for i in range(5)]
+
+def test_retryable_errors_are_retried():
+    client = StubClient({
+        "q1": [_error(RateLimitError, 429), _error(InternalServerError, 500)],
+        "q3": [_error(RateLimitError, 429)]
+    })
+    
+    assert _run(client) == [f"answer q{i}" for i in range(5)]
+    assert client.calls.count("q1") == 3
+    assert client.calls.count("q3") == 2
+
+def test_bad_request_is_not_retried():
+    client = StubClient({"q2": [_error(BadRequestError, 400)]})
+    
+    assert _run(client) == ["answer q0", "answer q1", None, "answer q3", "answer q4"]
+    assert client.calls.count("q2") == 1
+
+def test_gives_up_after_max_attempts():
+    client = StubClient({"q0": [_error(InternalServerError, 503) for _ in range(3)]})
+    
+    assert _run(client, count=2, max_attempts=3) == [None, "answer q1"]
+    assert client.calls.count("q0") == 3